@@ -1,7 +1,9 @@
 import argparse
-import os
-import cv2
-from src.production import make_masks, data_to_paths, create_folder, get_setup, make_legend
+from src.production import data_to_studies, get_production_transforms
+from src.precision import PRECISIONS, calibration_batches
+from src.backends import BACKENDS
+from src.batch import run_batch
+from src.config import ProductionConfig
 
 # parser arguments
 parser = argparse.ArgumentParser()
@@ -22,33 +24,69 @@ parser.add_argument("--show_legend",
                     action="store_true",
                     default=False,
                     help="if \"show_legend\" legend shows on image")
+parser.add_argument("--batch_size",
+                    type=int,
+                    default=None,
+                    help="slices per forward pass, reduced automatically if memory runs out")
+parser.add_argument("--num_workers",
+                    type=int,
+                    default=None,
+                    help="number of processes reading slices for prediction, only without --workers")
+parser.add_argument("--export_slices",
+                    action="store_true",
+                    default=False,
+                    help="if \"export_slices\" NIfTI slices are saved like png images")
+parser.add_argument("--cache_folder",
+                    default=None,
+                    help="folder to keep model outputs, repeated runs on the same slices skip the models")
+parser.add_argument("--fused",
+                    action="store_true",
+                    default=False,
+                    help="if \"fused\" one model with shared encoder is used (see src/fuse.py)")
+parser.add_argument("--precision",
+                    choices=PRECISIONS,
+                    default=None,
+                    help="inference precision, int8 \"static\" works on CPU only (see src/precision.py)")
+parser.add_argument("--calibration_data",
+                    default=None,
+                    help="images or NIfTI for \"static\" precision calibration, by default --data is used")
+parser.add_argument("--backend",
+                    choices=BACKENDS,
+                    default=None,
+                    help="runtime for models, exported ones are made by src/backends.py")
+parser.add_argument("--server",
+                    nargs="?",
+                    const=ProductionConfig.server_url,
+                    default=None,
+                    help="url of running inference server (src/server.py), models are not loaded locally")
+parser.add_argument("--workers",
+                    type=int,
+                    default=1,
+                    help="number of processes, every process gets its own studies")
+parser.add_argument("--threads",
+                    type=int,
+                    default=None,
+                    help="torch threads per worker, by default cores are shared equally")
+parser.add_argument("--mask_format",
+                    choices=["png", "nifti"],
+                    default="png",
+                    help="\"nifti\" saves one label volume per NIfTI input (labels in src/nifti.py), "
+                         "png images get png masks anyway")
+parser.add_argument("--overwrite",
+                    action="store_true",
+                    default=False,
+                    help="if \"overwrite\" finished studies are processed again instead of skipping")
 
-# parsing
-args = parser.parse_args()
-save_folder = args.save_folder
-
-# setup
-models, transforms = get_setup()
-
-# reformatting all data to png format and getting paths
-paths = data_to_paths(args.data, args.save_folder)
-
-# preparing place for segmentation
-for x in ['segmentations', 'annotations']:
-    create_folder(os.path.join(save_folder, x))
+if __name__ == '__main__':  # workers are spawned with import of this file
+    # parsing
+    args = parser.parse_args()
 
-# prediction
-for img, annotation, path in make_masks(paths, models, transforms, args.multi):
-    # annotation saving
-    print(path)
-    name = path.split('\\')[-1].split('.')[0].split('/')[-1]
-    print(name)
-    with open(os.path.join(save_folder, 'annotations', name + '_annotation.txt'), mode='w') as f:
-        f.write(annotation)
+    # static quantization is calibrated once for every worker
+    calibration = None
+    if args.precision == 'static' and not args.server:
+        calibration_studies = data_to_studies(args.calibration_data or args.data, args.save_folder)
+        calibration = calibration_batches(calibration_studies, get_production_transforms()[0],
+                                          ProductionConfig.calibration_slices)
 
-    # image saving
-    path = os.path.join(save_folder, 'segmentations', name + '_mask.png')
-    if args.show_legend:
-        img = make_legend(img, annotation)
-    cv2.imwrite(path, img)
-    print(path, annotation, '', sep='\n')
+    # prediction, studies are read while they are processed
+    run_batch(args, calibration)
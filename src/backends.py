@@ -0,0 +1,89 @@
+import argparse
+import os
+from functools import partial
+import torch
+import torch.nn as nn
+from engine import LazyModels
+
+BACKENDS = ('eager', 'torchscript', 'onnx')
+MODEL_NAMES = ('binary', 'multi', 'lung')  # order of models from get_setup
+EXTENSIONS = dict(torchscript='.pt', onnx='.onnx')
+
+
+class ExportModel(nn.Module):
+    # slice normalization and argmax are folded into exported model
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, X):
+        X = X / X.flatten(1).max(1)[0].clamp(min=1e-9).view(-1, 1, 1, 1)
+        return torch.argmax(self.model(X), 1).to(torch.uint8)
+
+
+def export_models(models, folder, formats=('torchscript', 'onnx'), size=512):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    example = torch.rand(1, 1, size, size, device=next(models[0].parameters()).device)
+    for name, model in zip(MODEL_NAMES, models):
+        model = ExportModel(model).eval()
+        if 'torchscript' in formats:
+            path = os.path.join(folder, name + EXTENSIONS['torchscript'])
+            with torch.no_grad():
+                torch.jit.save(torch.jit.trace(model, example), path)
+            print(f'Saved to {path}')
+        if 'onnx' in formats:
+            path = os.path.join(folder, name + EXTENSIONS['onnx'])
+            torch.onnx.export(model, example, path, input_names=['image'], output_names=['mask'],
+                              dynamic_axes={'image': {0: 'batch'}, 'mask': {0: 'batch'}}, opset_version=11)
+            print(f'Saved to {path}')
+
+
+class OnnxModel:
+    # ONNX Runtime session with the same call as torch model
+    def __init__(self, path, threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, X):
+        mask, = self.session.run(None, {'image': X.cpu().numpy()})
+        return torch.from_numpy(mask)
+
+
+def predict_exported(model, X):
+    with torch.no_grad():
+        return model(X)
+
+
+def load_exported(backend, folder, device):
+    if backend not in EXTENSIONS:
+        raise ValueError(f'Backend \"{backend}\" is not in {tuple(EXTENSIONS)}')
+    # models return argmax maps themselves and are loaded on first use
+    paths = [os.path.join(folder, name + EXTENSIONS[backend]) for name in MODEL_NAMES]
+    if backend == 'torchscript':
+        loaders = [partial(load_torchscript, path, device) for path in paths]
+    else:
+        # intra-op threads are shared between concurrently running sessions
+        threads = max(1, (os.cpu_count() or 1) // len(paths))
+        loaders = [partial(OnnxModel, path, threads) for path in paths]
+    return LazyModels(loaders, backend)
+
+
+def load_torchscript(path, device):
+    return torch.jit.load(path, map_location=device).eval()
+
+
+if __name__ == '__main__':
+    from production import get_setup
+    from config import ProductionConfig
+
+    parser = argparse.ArgumentParser(description='export models for TorchScript or ONNX Runtime backends')
+    parser.add_argument('--formats', nargs='+', choices=BACKENDS[1:], default=list(BACKENDS[1:]))
+    parser.add_argument('--folder', default=ProductionConfig.export_folder)
+    args = parser.parse_args()
+
+    models, _ = get_setup(fused=False, precision='fp32', backend='eager')
+    export_models(models, args.folder, args.formats)
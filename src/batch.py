@@ -0,0 +1,154 @@
+import json
+import multiprocessing
+import os
+import time
+from functools import partial
+import torch
+from client import InferenceClient
+from config import ProductionConfig
+from production import path_to_study, make_masks, get_predictions, create_folder, get_setup, get_cache
+from nifti import NiftiMaskWriter
+from writer import OutputWriter
+from report import StudyReport, save_table, load_result
+
+_worker = {}  # setup of current process
+
+
+def study_name(path):
+    return os.path.basename(path).split('.')[0]
+
+
+def list_studies(data):
+    if not os.path.isdir(data):  # single file
+        return [data]
+    return [os.path.join(data, x) for x in sorted(os.listdir(data))]
+
+
+def done_path(save_folder, path):
+    return os.path.join(save_folder, 'done', study_name(path) + '.json')
+
+
+def setup_worker(args, calibration=None, threads=None):
+    # models are loaded once per process, server keeps its own models
+    if threads:
+        torch.set_num_threads(threads)
+    _worker.update(client=None, models=None, transforms=None, cache=None)
+    if args.server:
+        _worker['client'] = InferenceClient(args.server)
+    else:
+        _worker['models'], _worker['transforms'] = get_setup(args.fused, args.precision, calibration, args.backend)
+        _worker['cache'] = get_cache(args.cache_folder, args.fused, args.precision, args.backend)
+
+
+def process_study(path, args, verbose=False):
+    # study is converted only when its worker gets to it
+    start = time.perf_counter()
+    slices = 0
+    try:
+        study = path_to_study(path, args.save_folder, args.export_slices)
+        if study is None:
+            raise ValueError('not supported or not exists')
+        paths, volume = study
+
+        # NIfTI studies get volumes in mL
+        if hasattr(volume, 'spacing'):
+            report = StudyReport(study_name(path), args.multi, volume.spacing, volume.shape[1:])
+        else:
+            report = StudyReport(study_name(path), args.multi)
+
+        client = _worker['client']
+        if client is not None:
+            predictions = client.get_predictions(paths, args.multi, volume)
+        else:
+            # pool processes are daemonic and can't start DataLoader workers
+            num_workers = 0 if args.workers > 1 else args.num_workers
+            predictions = get_predictions(paths, _worker['models'], _worker['transforms'], args.multi, args.batch_size,
+                                          num_workers, volume, _worker['cache'])
+
+        if args.mask_format == 'nifti' and hasattr(volume, 'image'):
+            # one label volume instead of png per slice
+            mask_path = os.path.join(args.save_folder, 'segmentations', study_name(path) + '_mask.nii.gz')
+            with NiftiMaskWriter(volume, mask_path) as mask_writer:
+                for i, (_, pred, lung, counts) in enumerate(predictions):
+                    mask_writer.add(i, pred, lung, args.multi)
+                    report.update(counts)
+                    slices += 1
+            if verbose:
+                print(mask_path)
+        else:
+            # files are written in background while next slices are predicted
+            masks = make_masks(paths, None, None, args.multi, predictions=predictions)
+            with OutputWriter(args.save_folder, args.show_legend, max_queue=ProductionConfig.writer_queue) as writer:
+                for img, annotation, slice_path, stats in masks:
+                    writer.submit(img, annotation, slice_path)
+                    report.update(stats['counts'])
+                    slices += 1
+                    if verbose:
+                        print(slice_path, annotation, '', sep='\n')
+    except Exception as e:
+        return path, slices, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+
+    # marker of finished study for resuming is written after report
+    report.save(os.path.join(args.save_folder, 'reports'))
+    seconds = time.perf_counter() - start
+    marker = done_path(args.save_folder, path)
+    with open(marker + '.tmp', 'w') as f:
+        json.dump(dict(slices=slices, seconds=seconds), f)
+    os.replace(marker + '.tmp', marker)
+    return path, slices, seconds, None
+
+
+def run_batch(args, calibration=None):
+    for x in ['', 'segmentations', 'annotations', 'reports', 'done']:
+        create_folder(os.path.join(args.save_folder, x))
+
+    # finished studies are skipped
+    studies = list_studies(args.data)
+    todo = [path for path in studies if args.overwrite or not os.path.exists(done_path(args.save_folder, path))]
+    skipped = len(studies) - len(todo)
+    if skipped:
+        print(f'Skipping {skipped} finished studies')
+
+    pool = None
+    start = time.perf_counter()
+    if args.workers > 1 and args.num_workers:
+        print('--num_workers is ignored with --workers, slices are read in study processes')
+    if args.workers <= 1:
+        setup_worker(args, calibration, args.threads)
+        results = (process_study(path, args, verbose=True) for path in todo)
+    else:
+        # spawn, because CUDA doesn't work in forked processes
+        threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+        pool = multiprocessing.get_context('spawn').Pool(args.workers, initializer=setup_worker,
+                                                         initargs=(args, calibration, threads))
+        results = pool.imap_unordered(partial(process_study, args=args), todo)
+
+    slices, finished, failed = 0, 0, 0
+    for i, (path, study_slices, seconds, error) in enumerate(results, 1):
+        slices += study_slices
+        if error is None:
+            finished += 1
+            print(f'[{i}/{len(todo)}] {study_name(path)}: {study_slices} slices, {seconds:.1f}s')
+        else:
+            failed += 1
+            print(f'[{i}/{len(todo)}] {study_name(path)}: failed, {error}')
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # combined table of every finished study, resumed ones included
+    reports = [load_result(os.path.join(args.save_folder, 'reports'), study_name(path)) for path in studies]
+    reports = [report for report in reports if report is not None]
+    if reports:
+        save_table(reports, os.path.join(args.save_folder, 'reports.csv'))
+        print(f'Report of {len(reports)} studies: {os.path.join(args.save_folder, "reports.csv")}')
+
+        # with skip_empty_slices disease models skip exactly these slices
+        total = sum(report['slices'] for report in reports)
+        lungless = sum(report.get('lungless_slices', 0) for report in reports)
+        print(f'Slices without lungs: {lungless} of {total}, {lungless / max(total, 1) * 100:.1f}%')
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f'Studies: {finished} finished, {failed} failed, {skipped} skipped')
+    print(f'Slices: {slices} in {elapsed:.1f}s')
+    print(f'Throughput: {slices / elapsed:.2f} slices/s, {finished / elapsed:.3f} studies/s')
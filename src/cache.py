@@ -0,0 +1,77 @@
+import hashlib
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+import numpy as np
+
+
+class PredictionCache:
+    # per-slice argmax maps of every model keyed by hash of the model input,
+    # least recently used slices are dropped from memory, folder keeps everything on disk
+    def __init__(self, max_size=512, folder=None, salt=''):
+        self.max_size = max_size
+        self.folder = folder
+        self.salt = salt.encode()
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if folder is not None and not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def key(self, image):
+        image = np.ascontiguousarray(image)
+        hasher = hashlib.sha1(self.salt)
+        hasher.update(str((image.shape, image.dtype.str)).encode())
+        hasher.update(image.tobytes())
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def get(self, key):
+        # copy of cached outputs, empty dict if slice is unknown
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return dict(self._data[key])
+        if self.folder is not None and os.path.exists(self._path(key)):
+            # unreadable file is a miss, outputs are predicted and written again
+            try:
+                with np.load(self._path(key)) as loaded:
+                    outputs = {name: loaded[name] for name in loaded.files}
+            except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+                outputs = None
+            if outputs is not None:
+                self._store(key, outputs)
+                self.hits += 1
+                return dict(outputs)
+        self.misses += 1
+        return {}
+
+    def update(self, key, outputs):
+        with self._lock:
+            known = self._data.get(key, {})
+        if all(name in known for name in outputs):
+            return
+        outputs = {**known, **outputs}
+        self._store(key, outputs)
+        if self.folder is not None:
+            # file appears complete, killed run or other worker never leaves half-written one
+            temporary = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temporary, 'wb') as f:
+                np.savez_compressed(f, **outputs)
+            os.replace(temporary, self._path(key))
+
+    def _store(self, key, outputs):
+        with self._lock:
+            self._data[key] = outputs
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
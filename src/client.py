@@ -0,0 +1,47 @@
+import io
+import json
+import os
+from urllib.request import Request, urlopen
+import numpy as np
+from config import ProductionConfig
+from engine import prefetch
+
+
+class InferenceClient:
+    # predictions from inference server (src/server.py), files are sent by paths
+    def __init__(self, url=None, timeout=None):
+        self.url = (url or ProductionConfig.server_url).rstrip('/')
+        self.timeout = timeout or ProductionConfig.server_timeout
+
+    def available(self):
+        try:
+            with urlopen(self.url + '/health', timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def predict(self, request):
+        request = Request(self.url + '/predict', data=json.dumps(request).encode(),
+                          headers={'Content-Type': 'application/json'})
+        with urlopen(request, timeout=self.timeout) as response:
+            # list of (img, pred, lung, counts) of every slice
+            loaded = np.load(io.BytesIO(response.read()))
+            names = ('img', 'pred', 'lung', 'counts')
+            return [tuple(loaded[f'{name}_{i}'] for name in names) for i in range(int(loaded['slices']))]
+
+    def get_predictions(self, paths, multi_class=True, volume=None, chunk_size=None):
+        # same output as production.get_predictions, next chunk is requested while current one is used
+        chunk_size = chunk_size or ProductionConfig.server_chunk_size
+        if volume is not None:
+            if not hasattr(volume, 'path'):
+                raise ValueError('Only volumes read from NIfTI files can be sent to server')
+            requests = [dict(nifti=os.path.abspath(volume.path), start=start, stop=start + chunk_size)
+                        for start in range(0, len(volume), chunk_size)]
+        else:
+            requests = [dict(paths=[os.path.abspath(path) for path in paths[start:start + chunk_size]])
+                        for start in range(0, len(paths), chunk_size)]
+
+        responses = (self.predict(dict(request, multi_class=multi_class)) for request in requests)
+        for results in prefetch(responses, depth=1):
+            for img, pred, lung, counts in results:
+                yield img, pred.astype(np.float32), lung.astype(np.float32), counts
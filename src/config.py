@@ -22,6 +22,15 @@ class BinaryModelConfig:
     best_dict = 'checkpoints/Binary.pth'
     link = 'https://drive.google.com/uc?id=1uUb8rw8JM6sG9xtaahBrr4SCBcWB70qr'
 
+    # training data loading (src/data_functions.py)
+    num_workers = 4
+    prefetch_factor = 2  # batches prepared in advance by every worker
+    pin_memory = True
+    persistent_workers = True  # workers are kept between epochs
+    patient_sampler = True  # slices of one patient follow each other, patients are shuffled
+    skip_uniform_slices = True  # blank slices are removed once when index is built
+    log_interval = 50  # steps between reading loss and score from device
+
 
 class MultiModelConfig:
     seed = 42
@@ -46,6 +55,15 @@ class MultiModelConfig:
     best_dict = 'checkpoints/MultiClass.pth'
     link = 'https://drive.google.com/uc?id=1W8V3t-TDXH7Bwem6-2I6vYKLmQmOiyXa'
 
+    # training data loading (src/data_functions.py)
+    num_workers = 4
+    prefetch_factor = 2  # batches prepared in advance by every worker
+    pin_memory = True
+    persistent_workers = True  # workers are kept between epochs
+    patient_sampler = True  # slices of one patient follow each other, patients are shuffled
+    skip_uniform_slices = True  # blank slices are removed once when index is built
+    log_interval = 50  # steps between reading loss and score from device
+
 
 class LungsModelConfig:
     seed = 42
@@ -69,4 +87,80 @@ class LungsModelConfig:
     backbone = 'resnext101_32x4d'
     encoder_weights = 'swsl'
     best_dict = 'checkpoints/Lungs.pth'
-    link = 'https://drive.google.com/uc?id=1n0evx7Rk0z5MKqo1sXZtX3qkWlwAuTYB'
\ No newline at end of file
+    link = 'https://drive.google.com/uc?id=1n0evx7Rk0z5MKqo1sXZtX3qkWlwAuTYB'
+
+    # training data loading (src/data_functions.py)
+    num_workers = 4
+    prefetch_factor = 2  # batches prepared in advance by every worker
+    pin_memory = True
+    persistent_workers = True  # workers are kept between epochs
+    patient_sampler = True  # slices of one patient follow each other, patients are shuffled
+    skip_uniform_slices = True  # blank slices are removed once when index is built
+    log_interval = 50  # steps between reading loss and score from device
+
+
+class FusedModelConfig:
+    seed = 42
+    in_channels = 1
+    pre_transforms = [
+        dict(
+            name="Resize",
+            params=dict(
+                height=512,
+                width=512,
+                p=1.0,
+            )
+        ),
+    ]
+    augmentations = []
+    post_transforms = []
+    heads = dict(binary=2, multi=4, lung=3)  # output channels of every head
+
+    model = 'FusedUnetPlusPlus'
+    backbone = 'resnext101_32x4d'
+    encoder_weights = None  # initialized from BinaryModelConfig checkpoint
+    decoder_channels = (256, 128, 64, 32, 16)
+    best_dict = 'checkpoints/Fused.pth'
+
+    # distillation from separate models
+    batch_size = 4
+    epochs = 3
+    optimizer_params = dict(lr=1e-4)
+
+
+class ProductionConfig:
+    batch_size = 8  # slices per forward pass, halved automatically on out-of-memory
+    num_workers = 0  # DataLoader workers for reading and transforming slices
+    window_center = -600  # NIfTI windowing in Hounsfield units
+    window_width = 1500
+    nifti_chunk_slices = 16  # slices of .nii.gz decompressed at once, file stays open between chunks
+    cache_size = 512  # slices with cached model outputs in memory, 0 disables cache
+    cache_folder = None  # folder to keep cached outputs between runs
+    concurrent_models = True  # models run in parallel: CUDA streams on GPU, threads on CPU
+    prefetch_batches = 2  # batches prepared in background while models are busy
+    fused_model = False  # one shared encoder with three heads instead of three models
+    precision = 'fp32'  # 'fp32', 'bf16' (CPU autocast), 'fp16' (CUDA autocast) or 'static' (int8 on CPU)
+    calibration_slices = 32  # slices for static quantization calibration
+    backend = 'eager'  # 'eager', 'torchscript' or 'onnx' (models exported with src/backends.py)
+    export_folder = 'checkpoints/exported'
+    lazy_models = True  # models are loaded on first use, multi-class one only for multi-class requests
+    model_cache_folder = 'checkpoints/ready'  # pickled ready-to-run models, None disables
+    writer_queue = 32  # slices waiting for background writing of outputs
+    skip_empty_slices = True  # disease models run only on slices where lung model finds lungs
+    lung_crop = False  # disease models see only window around lungs (with skip_empty_slices, eager models only)
+    lung_crop_margin = 16  # pixels around lungs in window
+    tta = 'none'  # test-time augmentation policy from tta_policies (see src/tta.py)
+    tta_policies = dict(
+        none=(),
+        flip=('hflip',),
+        flips=('hflip', 'vflip'),
+        d4=('hflip', 'vflip', 'rot90', 'rot180', 'rot270', 'transpose', 'antitranspose'),
+    )
+    tta_models = ('binary', 'multi')  # lung model tells left lung from right one, so it isn't mirrored
+
+    # inference server (src/server.py)
+    server_url = 'http://127.0.0.1:8765'
+    server_max_wait = 0.01  # seconds for batch to be filled with slices of other requests
+    server_max_queue = 512  # waiting slices, new requests are rejected over it
+    server_timeout = 600  # seconds for one request
+    server_chunk_size = 32  # slices per request from client
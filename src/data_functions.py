@@ -1,10 +1,11 @@
+import os
 import random
 
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 import numpy as np
-from sklearn.model_selection import train_test_split, KFold
 from utils import get_paths
+from shards import ShardDataset, load_shards, get_shard_paths, is_uniform
 import albumentations as A
 
 
@@ -31,9 +32,65 @@ class Covid19Dataset(Dataset):
         mask = torch.from_numpy(np.array([mask], dtype=np.uint8))
         return image, mask
 
+    def uniform(self, index):
+        return is_uniform(np.load(self.paths[index])['image'])
 
-def data_generator(cfg):
-    image_paths = get_paths(cfg)
+    def patients(self):
+        # indices of dataset grouped by patient, file names are "<patient>_<slice>"
+        groups = {}
+        for i, path in enumerate(self.paths):
+            key = (os.path.dirname(path), os.path.basename(path).split('_')[0])
+            groups.setdefault(key, []).append(i)
+        return list(groups.values())
+
+
+class UniformFlags(Dataset):
+    # blank slice flags of dataset read by DataLoader workers
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return bool(self.dataset.uniform(index))
+
+
+def drop_uniform(dataset, num_workers=0):
+    # blank slices are removed from index once instead of skipping batches in training loop
+    loader = DataLoader(UniformFlags(dataset), batch_size=64, num_workers=num_workers)
+    uniform = torch.cat([flags for flags in loader]).tolist() if len(dataset) else []
+    dataset.paths = [path for path, flag in zip(dataset.paths, uniform) if not flag]
+    dataset._len = len(dataset.paths)
+    print(f'Uniform slices removed: {sum(uniform)} of {len(uniform)}')
+    return dataset
+
+
+class PatientSampler(Sampler):
+    # patients in random order and slices of every patient one after another,
+    # so neighbouring samples are read from the same files
+    def __init__(self, patients, shuffle=True):
+        self.patients = patients
+        self.shuffle = shuffle
+        self._len = sum(len(patient) for patient in patients)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        patients = [list(patient) for patient in self.patients]
+        if self.shuffle:
+            random.shuffle(patients)
+            for patient in patients:
+                random.shuffle(patient)
+        for patient in patients:
+            yield from patient
+
+
+def data_generator(cfg, image_paths=None):
+    from sklearn.model_selection import train_test_split, KFold  # only for training
+
+    image_paths = get_paths(cfg) if image_paths is None else image_paths
     image_paths = np.asarray(image_paths)
     train_paths, val_paths = [], []
 
@@ -69,9 +126,33 @@ def get_transforms(cfg):
 
 def get_loaders(cfg):
     train_transforms, test_transforms = get_transforms(cfg)
-    train_paths, val_paths = data_generator(cfg)
-    train_ds = Covid19Dataset(train_paths, transform=train_transforms)
-    val_ds = Covid19Dataset(val_paths, transform=train_transforms)
-    train_dl = DataLoader(train_ds, batch_size=cfg.batch_size, drop_last=True)
-    val_dl = DataLoader(val_ds, batch_size=cfg.batch_size, drop_last=True)
+    if getattr(cfg, 'data_format', 'npz') == 'shards':  # packed with src/shards.py
+        shards = load_shards(cfg)
+        train_paths, val_paths = data_generator(cfg, get_shard_paths(cfg, shards))
+        train_ds = ShardDataset(shards, train_paths, transform=train_transforms)
+        val_ds = ShardDataset(shards, val_paths, transform=train_transforms)
+    else:
+        train_paths, val_paths = data_generator(cfg)
+        train_ds = Covid19Dataset(train_paths, transform=train_transforms)
+        val_ds = Covid19Dataset(val_paths, transform=train_transforms)
+
+    num_workers = getattr(cfg, 'num_workers', 0)
+    if getattr(cfg, 'skip_uniform_slices', False):
+        train_ds = drop_uniform(train_ds, num_workers)
+        val_ds = drop_uniform(val_ds, num_workers)
+    train_dl = make_loader(train_ds, cfg, shuffle=True)
+    val_dl = make_loader(val_ds, cfg, shuffle=False)
     return train_dl, val_dl
+
+
+def make_loader(dataset, cfg, shuffle=True):
+    # loading parameters from model config, missing ones keep plain DataLoader behaviour
+    num_workers = getattr(cfg, 'num_workers', 0)
+    params = dict(batch_size=cfg.batch_size, drop_last=True, num_workers=num_workers,
+                  pin_memory=getattr(cfg, 'pin_memory', False) and torch.cuda.is_available())
+    if num_workers > 0:  # only for worker processes
+        params.update(prefetch_factor=getattr(cfg, 'prefetch_factor', 2),
+                      persistent_workers=getattr(cfg, 'persistent_workers', False))
+    if getattr(cfg, 'patient_sampler', False):
+        params['sampler'] = PatientSampler(dataset.patients(), shuffle=shuffle)
+    return DataLoader(dataset, **params)
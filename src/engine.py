@@ -0,0 +1,135 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+
+def prefetch(iterable, depth=2):
+    # next items are prepared by background thread while current one is processed
+    if depth <= 0:
+        yield from iterable
+        return
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+class LazyModels:
+    # sequence of models, every model is loaded on first use
+    def __init__(self, loaders, backend='eager'):
+        self.loaders = loaders
+        self.backend = backend
+        self._models = [None] * len(loaders)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.loaders)
+
+    def __getitem__(self, index):
+        with self._lock:
+            if self._models[index] is None:
+                self._models[index] = self.loaders[index]()
+            return self._models[index]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def loaded(self):
+        return [model is not None for model in self._models]
+
+
+def predict_argmax(model, X):
+    # grad mode is thread local, so it is disabled in every thread
+    with torch.no_grad():
+        return torch.argmax(model(X), 1).to(torch.uint8)
+
+
+class ModelRunner:
+    # runs several models on their inputs at the same time:
+    # CUDA stream per model on GPU, thread per model with own share of intra-op threads on CPU,
+    # predict is one function for every model or list of functions by model index
+    def __init__(self, models, device, concurrent=True, predict=predict_argmax):
+        self.models = models
+        self.device = device
+        self.concurrent = concurrent
+        self.predict = predict
+        self._streams = None
+        self._executor = None
+        self._num_threads = None
+
+    def run(self, jobs):
+        # jobs are pairs of model index and input, argmax maps are returned in the same order and stay on device
+        if not self.concurrent or len(jobs) < 2:
+            return [self._predict(i)(self.models[i], X) for i, X in jobs]
+        if self.device.type == 'cuda':
+            return self._run_streams(jobs)
+        return self._run_threads(jobs)
+
+    def _run_streams(self, jobs):
+        if self._streams is None:
+            self._streams = [torch.cuda.Stream(self.device) for _ in range(len(self.models))]  # models stay unloaded
+        current = torch.cuda.current_stream(self.device)
+
+        outputs = []
+        for i, X in jobs:
+            stream = self._streams[i]
+            stream.wait_stream(current)  # inputs are ready
+            with torch.cuda.stream(stream):
+                X.record_stream(stream)
+                outputs.append(self._predict(i)(self.models[i], X))
+        for i, _ in jobs:
+            current.wait_stream(self._streams[i])
+        for output in outputs:  # outputs are used on current stream
+            output.record_stream(current)
+        return outputs
+
+    def _run_threads(self, jobs):
+        if self._executor is None:
+            self._num_threads = torch.get_num_threads()
+            threads = max(1, self._num_threads // len(self.models))
+            self._executor = ThreadPoolExecutor(len(self.models), initializer=torch.set_num_threads,
+                                                initargs=(threads,))
+        futures = [self._executor.submit(self._predict(i), self.models[i], X) for i, X in jobs]
+        return [future.result() for future in futures]
+
+    def _predict(self, index):
+        return self.predict[index] if isinstance(self.predict, (list, tuple)) else self.predict
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+            torch.set_num_threads(self._num_threads)
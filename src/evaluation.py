@@ -0,0 +1,60 @@
+import time
+import numpy as np
+import torch
+from production import get_predictions
+
+
+def dice(a, b):
+    total = np.sum(a) + np.sum(b)
+    return 1.0 if total == 0 else 2 * np.sum(a * b) / total
+
+
+def lesion_percents(pred, lung):
+    # ground-glass and consolidation percent of left and right lung
+    percents = []
+    for lesion in [1, 2]:
+        for side in [1, 2]:
+            lung_side = lung == side
+            percents.append(np.sum((pred == lesion) * lung_side) / max(np.sum(lung_side), 1) * 100)
+    return np.array(percents)
+
+
+def run_pipeline(studies, models, transforms, **kwargs):
+    # predictions of every slice, seconds and peak CUDA memory in MB
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    predictions = []
+    for paths, volume in studies:
+        for _, pred, lung, _ in get_predictions(paths, models, transforms, volume=volume, **kwargs):
+            predictions.append((pred, lung))
+    seconds = time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return predictions, seconds, peak
+
+
+def compare_predictions(reference, predictions):
+    # per-class dice and lesion percent error against reference pipeline
+    scores = {'ground-glass': [], 'consolidation': [], 'lungs': []}
+    percent_errors = []
+    for (ref_pred, ref_lung), (pred, lung) in zip(reference, predictions):
+        scores['ground-glass'].append(dice(ref_pred == 1, pred == 1))
+        scores['consolidation'].append(dice(ref_pred == 2, pred == 2))
+        scores['lungs'].append(dice(ref_lung > 0, lung > 0))
+        percent_errors.append(np.abs(lesion_percents(ref_pred, ref_lung) - lesion_percents(pred, lung)))
+    result = {name: float(np.mean(values)) for name, values in scores.items()}
+    result['percent_error'] = float(np.mean(percent_errors))
+    result['max_percent_error'] = float(np.max(percent_errors))
+    return result
+
+
+def parameters_size(models):
+    # MB of state dict, quantized weights included
+    models = [models] if isinstance(models, torch.nn.Module) else models
+    size = 0
+    for model in models:
+        for value in model.state_dict().values():
+            if isinstance(value, torch.Tensor):
+                size += value.numel() * value.element_size()
+    return size / 2 ** 20
@@ -0,0 +1,109 @@
+import argparse
+import random
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, ConcatDataset, Sampler
+from tqdm import tqdm
+from config import FusedModelConfig, ProductionConfig
+from fused import FusedUnetPlusPlus, HEADS
+from production import get_setup, data_to_studies, make_dataset
+from evaluation import run_pipeline, compare_predictions, parameters_size
+
+
+class StudySampler(Sampler):
+    # studies in random order, chunks of every study in file order and slices shuffled inside chunk,
+    # so compressed volumes are only read forward and every chunk is decompressed once per epoch
+    def __init__(self, lengths, chunk_slices):
+        self.studies = []
+        start = 0
+        for length in lengths:
+            self.studies.append([list(range(start + i, start + min(i + chunk_slices, length)))
+                                 for i in range(0, length, chunk_slices)])
+            start += length
+        self._len = start
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for study in random.sample(self.studies, len(self.studies)):
+            for chunk in study:
+                yield from random.sample(chunk, len(chunk))
+
+
+def distill(fused, teachers, studies, transforms, cfg, device):
+    # every head learns argmax of its separate model
+    datasets = [make_dataset(paths, volume, transforms[0]) for paths, volume in studies]
+    sampler = StudySampler([len(dataset) for dataset in datasets], ProductionConfig.nifti_chunk_slices)
+    loader = DataLoader(ConcatDataset(datasets), batch_size=cfg.batch_size, sampler=sampler, drop_last=False)
+    optimizer = torch.optim.Adam(fused.parameters(), **cfg.optimizer_params)
+    criterion = nn.CrossEntropyLoss()
+
+    for epoch in range(1, cfg.epochs + 1):
+        fused.train()
+        loss_sum = 0
+        for X, _ in tqdm(loader, position=0, leave=True):
+            X = X.to(device)
+            X = X / torch.amax(X, dim=(1, 2, 3), keepdim=True).clamp(min=1e-9)
+            with torch.no_grad():
+                targets = {name: torch.argmax(teacher(X), 1) for name, teacher in zip(HEADS, teachers)}
+
+            optimizer.zero_grad()
+            outputs = fused(X)
+            loss = sum(criterion(outputs[name], targets[name]) for name in HEADS)
+            loss.backward()
+            optimizer.step()
+            loss_sum += loss.item()
+        print(f'Epoch #{epoch}: {loss_sum / len(loader):.6f}')
+    fused.eval()
+    return fused
+
+
+def build(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    teachers, transforms = get_setup(fused=False, lazy=False)
+    # lung and multi-class decoders get features of binary encoder, so merged model is useless without distillation
+    fused = FusedUnetPlusPlus(FusedModelConfig).init_from_models(teachers).to(device)
+    studies = data_to_studies(args.data, args.save_folder)
+    fused = distill(fused, teachers, studies, transforms, FusedModelConfig, device)
+    torch.save(fused.state_dict(), FusedModelConfig.best_dict)
+    print(f'Saved to {FusedModelConfig.best_dict}')
+
+
+def validate(args):
+    studies = data_to_studies(args.data, args.save_folder)
+    models, transforms = get_setup(fused=False, lazy=False)
+    fused, _ = get_setup(fused=True, lazy=False)
+
+    reference, reference_time, reference_peak = run_pipeline(studies, models, transforms)
+    predictions, fused_time, fused_peak = run_pipeline(studies, fused, transforms)
+
+    # separate models are reference
+    scores = compare_predictions(reference, predictions)
+    slices = len(reference)
+    print(f'Slices: {slices}')
+    print('Dice with separate models:')
+    for name in ['ground-glass', 'consolidation', 'lungs']:
+        print(f'{name:>15}: {scores[name]:.4f}')
+    print(f'Lesion percent error: {scores["percent_error"]:.3f}% (max {scores["max_percent_error"]:.3f}%)')
+    print('          |  separate  |  fused')
+    print(f'slices/s  | {slices / reference_time:10.2f} | {slices / fused_time:.2f}')
+    print(f'params MB | {parameters_size(models):10.1f} | {parameters_size(fused):.1f}')
+    print(f'peak MB   | {reference_peak:10.1f} | {fused_peak:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='shared encoder model from separate checkpoints')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='initialize from checkpoints and distill on data')
+    build_parser.add_argument('--data', required=True, help='images or NIfTI for distillation')
+    build_parser.add_argument('--save_folder', default='fused')
+    validate_parser = subparsers.add_parser('validate', help='compare with separate models')
+    validate_parser.add_argument('--data', required=True, help='images or NIfTI for validation')
+    validate_parser.add_argument('--save_folder', default='fused')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build(args)
+    else:
+        validate(args)
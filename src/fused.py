@@ -0,0 +1,74 @@
+import torch
+import torch.nn as nn
+
+HEADS = ('binary', 'multi', 'lung')  # same order as models from get_setup
+
+
+def unwrap(model):
+    # segmentation_models_pytorch model inside of custom wrapper
+    for module in model.modules():
+        if all(hasattr(module, name) for name in ['encoder', 'decoder', 'segmentation_head']):
+            return module
+    raise ValueError(f'{type(model).__name__} has no encoder, decoder and segmentation head')
+
+
+class FusedUnetPlusPlus(nn.Module):
+    # one encoder for every task, UNet++ decoder and segmentation head per task
+    def __init__(self, cfg):
+        from segmentation_models_pytorch.encoders import get_encoder
+        from segmentation_models_pytorch.unetplusplus.decoder import UnetPlusPlusDecoder
+        from segmentation_models_pytorch.base import SegmentationHead
+
+        super().__init__()
+        self.encoder = get_encoder(cfg.backbone, in_channels=cfg.in_channels, depth=len(cfg.decoder_channels),
+                                   weights=cfg.encoder_weights)
+        self.decoders = nn.ModuleDict()
+        self.segmentation_heads = nn.ModuleDict()
+        for name in HEADS:
+            self.decoders[name] = UnetPlusPlusDecoder(encoder_channels=self.encoder.out_channels,
+                                                      decoder_channels=cfg.decoder_channels,
+                                                      n_blocks=len(cfg.decoder_channels))
+            self.segmentation_heads[name] = SegmentationHead(in_channels=cfg.decoder_channels[-1],
+                                                             out_channels=cfg.heads[name], kernel_size=3)
+
+    def decode(self, features, name):
+        return self.segmentation_heads[name](self.decoders[name](*features))
+
+    def forward(self, x, heads=HEADS):
+        features = self.encoder(x)
+        return {name: self.decode(features, name) for name in heads}
+
+    def init_from_models(self, models, encoder_from='binary'):
+        # decoders and heads are copied from separate models,
+        # encoder from the model with the same backbone
+        for name, model in zip(HEADS, models):
+            model = unwrap(model)
+            self.decoders[name].load_state_dict(model.decoder.state_dict())
+            self.segmentation_heads[name].load_state_dict(model.segmentation_head.state_dict())
+            if name == encoder_from:
+                self.encoder.load_state_dict(model.encoder.state_dict())
+        return self
+
+
+class FusedRunner:
+    # ModelRunner for fused model: encoder runs once per input, then requested heads
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+
+    def run(self, jobs):
+        outputs = [None] * len(jobs)
+        groups = {}
+        for position, (index, X) in enumerate(jobs):
+            groups.setdefault(id(X), (X, []))[1].append((position, HEADS[index]))
+
+        with torch.no_grad():
+            for X, heads in groups.values():
+                features = self.model.encoder(X)
+                for position, name in heads:
+                    output = self.model.decode(features, name)
+                    outputs[position] = torch.argmax(output, 1).to(torch.uint8)
+        return outputs
+
+    def close(self):
+        pass
@@ -0,0 +1,166 @@
+import os
+import threading
+import cv2
+import numpy as np
+
+# labels of NIfTI masks, lesion labels replace lung ones
+LABELS = dict(background=0, lung_left=1, lung_right=2, ground_glass=3, consolidation=4)
+
+
+def window_image(image, window_center=-600, window_width=1500):
+    img_min = window_center - window_width // 2
+    img_max = window_center + window_width // 2
+    window_image = image.copy()
+    window_image[window_image < img_min] = img_min
+    window_image[window_image > img_max] = img_max
+    return window_image
+
+
+def normalize_slice(image, window_center=-600, window_width=1500):
+    # per-slice reference for window_volume
+    image = window_image(image, window_center, window_width)
+    image += abs(np.min(image))
+    return (image / np.max(image)).astype(np.float32)
+
+
+def window_volume(images, window_center=-600, window_width=1500, out=None):
+    # windowing and [0;1] normalization of every slice (first axis) at once,
+    # result matches normalize_slice for every slice, slices with zero range are 0 instead of NaN
+    img_min = window_center - window_width // 2
+    img_max = window_center + window_width // 2
+    if out is None:
+        out = np.empty(images.shape, dtype=np.float32)
+
+    # float64 data is processed in float64 like in normalize_slice
+    work_dtype = np.result_type(images.dtype, np.float32)
+    buffer = out if work_dtype == np.float32 else np.empty(images.shape, dtype=work_dtype)
+
+    axes = tuple(range(1, images.ndim))
+    np.clip(images, img_min, img_max, out=buffer)
+    buffer += np.abs(buffer.min(axis=axes, keepdims=True))
+    # uniform slices below window have zero range
+    maximum = buffer.max(axis=axes, keepdims=True)
+    np.divide(buffer, maximum, out=buffer, where=maximum > 0)
+    if buffer is not out:
+        out[...] = buffer
+    return out
+
+
+class NiftiSlices:
+    # NIfTI volume read by chunks of slices through nibabel array proxy,
+    # so only requested slices are in memory (uncompressed files are memory-mapped),
+    # file of compressed volume is kept open and chunks are read in order, so it is decompressed once
+    def __init__(self, path, window_center=-600, window_width=1500, chunk_slices=16):
+        self.path = path
+        self.window_center = window_center
+        self.window_width = window_width
+        self.chunk_slices = chunk_slices
+        self.compressed = path.endswith('.gz')
+        self.open()
+        self.shape = (self.image.shape[-1],) + tuple(self.image.shape[:2])
+        self.spacing = tuple(float(x) for x in self.image.header.get_zooms()[:3])  # mm
+        self._len = self.shape[0]
+
+    def open(self):
+        # every DataLoader worker opens file itself, shared gzip stream would be read from start again
+        import nibabel as nib  # only for NIfTI inputs
+        self.image = nib.load(self.path, mmap=True, keep_file_open=self.compressed)
+        self.dataobj = self.image.dataobj
+        self._chunk = None  # (start, slices) pair, replaced at once
+        self._lock = threading.Lock()
+
+    def close(self):
+        # file is released before it is removed, open files can't be removed on Windows
+        self.image, self.dataobj, self._chunk = None, None, None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['image', 'dataobj', '_chunk', '_lock']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if not self.compressed:
+            return self.read(index, index + 1)[0]
+        # slices of compressed volume come from chunk decompressed at once
+        start = index - index % self.chunk_slices
+        with self._lock:
+            chunk = self._chunk
+            if chunk is None or chunk[0] != start:
+                chunk = (start, self.read(start, start + self.chunk_slices))
+                self._chunk = chunk
+        return chunk[1][index - start]
+
+    def __iter__(self):
+        for batch in self.batches(self.chunk_slices):
+            yield from batch
+
+    def read(self, start, stop):
+        # (slices, height, width) array of windowed slices, slices axis is moved to front
+        images = np.asarray(self.dataobj[..., start:stop])
+        images = np.moveaxis(images, -1, 0)
+        return window_volume(images, self.window_center, self.window_width)
+
+    def batches(self, batch_size):
+        for start in range(0, self._len, batch_size):
+            yield self.read(start, start + batch_size)
+
+
+def encode_labels(pred, lung, multi_class=True):
+    # one label map from lesion and lungs masks, binary disease is labeled like ground-glass
+    labels = lung.astype(np.uint8)
+    labels[pred == 1] = LABELS['ground_glass']
+    if multi_class:
+        labels[pred == 2] = LABELS['consolidation']
+    return labels
+
+
+class NiftiMaskWriter:
+    # label volume with affine and header of input NIfTI, filled slice by slice
+    # in memory-mapped buffer, so it exists only once and only on disk
+    def __init__(self, reference, path):
+        self.reference = reference
+        self.path = path
+        self.shape = tuple(reference.image.shape[:3])
+        self._buffer_path = path + '.tmp'
+        self.labels = np.memmap(self._buffer_path, dtype=np.uint8, mode='w+', shape=self.shape, order='F')
+
+    def add(self, index, pred, lung, multi_class=True):
+        # predictions are at native slice resolution, masks of other size are resized
+        labels = encode_labels(pred, lung, multi_class)
+        if labels.shape != self.shape[:2]:
+            labels = cv2.resize(labels, (self.shape[1], self.shape[0]), interpolation=cv2.INTER_NEAREST)
+        self.labels[..., index] = labels
+
+    def close(self):
+        import nibabel as nib
+
+        header = self.reference.image.header.copy()
+        header.set_data_dtype(np.uint8)
+        header.set_slope_inter(1, 0)
+        image = nib.Nifti1Image(self.labels, self.reference.image.affine, header)
+        nib.save(image, self.path)
+        del image
+        self._remove_buffer()
+
+    def _remove_buffer(self):
+        # memory map is closed with its last reference
+        if self.labels is not None:
+            self.labels = None
+            os.remove(self._buffer_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._remove_buffer()
@@ -0,0 +1,72 @@
+import argparse
+import time
+import numpy as np
+import torch
+from utils import OneHotEncoder
+
+
+class ReferenceOneHotEncoder:
+    # previous per-pixel encoder, kept for equivalence check
+    def __init__(self, cfg):
+        self.zeros = [0] * cfg.num_classes
+
+    def encode_num(self, x):
+        zeros = self.zeros.copy()
+        zeros[int(x)] = 1
+        return zeros
+
+    def __call__(self, y):
+        y = np.array(y)
+        y = np.expand_dims(y, -1)
+        y = np.apply_along_axis(self.encode_num, -1, y)
+        y = np.swapaxes(y, -1, 1)
+        y = np.ascontiguousarray(y)
+        return torch.Tensor(y)
+
+
+class EncoderConfig:
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+
+
+def measure(function, repeats, device):
+    times = []
+    for _ in range(repeats):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        function()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='one-hot encoding of mask batches: equivalence and speed')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--num_classes', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    cfg = EncoderConfig(args.num_classes)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    y = torch.randint(0, args.num_classes, (args.batch_size, 1, args.size, args.size), dtype=torch.uint8)
+    reference_encoder, encoder = ReferenceOneHotEncoder(cfg), OneHotEncoder(cfg)
+
+    # same layout and values as per-pixel encoder, on CPU and on device
+    reference = reference_encoder(y)
+    for check_device in {torch.device('cpu'), device}:
+        encoded = encoder(y.to(check_device))
+        if encoded.shape != reference.shape or encoded.dtype != reference.dtype \
+                or not torch.equal(encoded.cpu(), reference):
+            raise AssertionError(f'Encoding on {check_device} differs from reference')
+    print(f'Equivalent: {tuple(reference.shape)} {reference.dtype}')
+
+    reference_time = measure(lambda: reference_encoder(y).to(device), args.repeats, device)
+    y_device = y.to(device)
+    encoder_time = measure(lambda: encoder(y_device), args.repeats, device)
+    print(f'per-pixel (CPU) + transfer: {reference_time * 1000:10.1f} ms')
+    print(f'vectorized on {device.type:<12}: {encoder_time * 1000:10.1f} ms')
+    print(f'speedup: {reference_time / max(encoder_time, 1e-9):.0f}x')
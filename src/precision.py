@@ -0,0 +1,132 @@
+import argparse
+import copy
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, ConcatDataset, Subset
+
+PRECISIONS = ('fp32', 'bf16', 'fp16', 'static')
+
+
+def autocast(device, precision):
+    # 'fp16' on GPU, 'bf16' on CPU: CUDA autocast of torch 1.9 has only float16
+    if precision == 'fp16':
+        if device.type != 'cuda':
+            raise ValueError('Precision \"fp16\" is supported only on CUDA')
+        return torch.cuda.amp.autocast()
+    if device.type == 'cuda':
+        raise ValueError('Precision \"bf16\" is supported only on CPU, use \"fp16\" on CUDA')
+    if not hasattr(torch, 'cpu') or not hasattr(torch.cpu, 'amp'):
+        raise ValueError('bfloat16 autocast on CPU is supported since torch 1.10')
+    return torch.cpu.amp.autocast(dtype=torch.bfloat16)
+
+
+class Autocast(nn.Module):
+    def __init__(self, module, precision):
+        super().__init__()
+        self.module = module
+        self.precision = precision
+
+    def forward(self, *args):
+        with autocast(args[0].device, self.precision):
+            output = self.module(*args)
+        if isinstance(output, torch.Tensor):
+            return output.float()
+        return output
+
+
+def quantize_static(model, calibration):
+    # int8 convolutions with activation ranges observed on calibration batches
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import prepare_fx, convert_fx
+
+    model = copy.deepcopy(model).cpu().eval()
+    prepared = prepare_fx(model, {'': get_default_qconfig('fbgemm')})
+    with torch.no_grad():
+        for X in calibration:
+            prepared(X)
+    return convert_fx(prepared)
+
+
+def calibration_batches(studies, transform, slices=32, batch_size=8):
+    # evenly spaced slices of studies normalized like in get_predictions
+    from production import make_dataset
+
+    dataset = ConcatDataset([make_dataset(paths, volume, transform) for paths, volume in studies])
+    step = max(1, len(dataset) // slices)
+    loader = DataLoader(Subset(dataset, range(0, len(dataset), step)), batch_size=batch_size)
+    batches = []
+    for X, _ in loader:
+        batches.append(X / torch.amax(X, dim=(1, 2, 3), keepdim=True).clamp(min=1e-9))
+    return batches
+
+
+def check_precision(precision, device, calibration=None, fused=False):
+    # errors of apply_precision before models are loaded
+    if precision not in PRECISIONS:
+        raise ValueError(f'Precision \"{precision}\" is not in {PRECISIONS}')
+    if precision == 'static' and device.type != 'cpu':
+        raise ValueError(f'Precision \"{precision}\" is supported only on CPU')
+    if precision == 'static' and calibration is None:
+        raise ValueError('Static quantization needs calibration batches')
+    if fused and precision not in ['fp32', 'bf16', 'fp16']:
+        raise ValueError(f'Precision \"{precision}\" is not supported for fused model')
+    if precision in ['bf16', 'fp16']:
+        autocast(device, precision)
+
+
+def apply_precision(models, precision, device, calibration=None):
+    # models from get_setup in requested precision
+    check_precision(precision, device, calibration, isinstance(models, nn.Module))
+    if precision == 'fp32':
+        return models
+
+    # shared encoder model is converted by parts
+    if isinstance(models, nn.Module):
+        models.encoder = Autocast(models.encoder, precision)
+        for name in list(models.decoders.keys()):
+            models.decoders[name] = Autocast(models.decoders[name], precision)
+        return models
+
+    if precision in ['bf16', 'fp16']:
+        return [Autocast(model, precision).eval() for model in models]
+    return [quantize_static(model, calibration) for model in models]
+
+
+def report(args):
+    from production import get_setup, data_to_studies
+    from evaluation import run_pipeline, compare_predictions, parameters_size
+
+    studies = data_to_studies(args.data, args.save_folder)
+    reference_models, transforms = get_setup(precision='fp32', backend='eager', lazy=False)
+    reference, reference_time, _ = run_pipeline(studies, reference_models, transforms)
+    slices = len(reference)
+    print(f'Slices: {slices}')
+    print('precision | ground-glass | consolidation |  lungs  | percent error | slices/s | params MB')
+    print(f'fp32      |       1.0000 |        1.0000 |  1.0000 |  0.000 (0.000) | {slices / reference_time:8.2f} | '
+          f'{parameters_size(reference_models):.1f}')
+
+    precisions = PRECISIONS[1:] if args.precision == 'all' else [args.precision]
+    for precision in precisions:
+        calibration_studies = data_to_studies(args.calibration_data or args.data, args.save_folder)
+        calibration = calibration_batches(calibration_studies, transforms[0], args.calibration_slices)
+        try:
+            models, _ = get_setup(precision=precision, calibration=calibration, backend='eager', lazy=False)
+        except (ValueError, RuntimeError) as e:
+            print(f'{precision:<9} | {e}')
+            continue
+        predictions, seconds, _ = run_pipeline(studies, models, transforms)
+        scores = compare_predictions(reference, predictions)
+        print(f'{precision:<9} | {scores["ground-glass"]:12.4f} | {scores["consolidation"]:13.4f} | '
+              f'{scores["lungs"]:7.4f} | {scores["percent_error"]:6.3f} ({scores["max_percent_error"]:.3f}) | '
+              f'{slices / seconds:8.2f} | {parameters_size(models):.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='dice and lesion percent error of reduced precision against fp32')
+    parser.add_argument('--data', required=True, help='images or NIfTI for comparison')
+    parser.add_argument('--precision', default='all', choices=('all',) + PRECISIONS[1:])
+    parser.add_argument('--calibration_data', default=None, help='images or NIfTI for static quantization, '
+                                                                 'by default --data is used')
+    parser.add_argument('--calibration_slices', type=int, default=32)
+    parser.add_argument('--save_folder', default='precision')
+    report(parser.parse_args())
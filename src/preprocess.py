@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from functools import partial
+import numpy as np
+from config import ProductionConfig
+from nifti import window_volume
+from shards import ShardWriter, merge_shards, shard_folder, INDEX
+
+# raw NIfTI image and mask volumes to training slices "<patient>_<slice>.npz" (see get_paths_1_dataset)
+# or to packed shard, converted volumes are listed in manifest with checksums of their files
+MANIFEST = '.preprocess.json'  # "<dataset_name>.preprocess.json" next to dataset folder
+NIFTI_EXTENSIONS = ('.nii', '.nii.gz')
+
+
+def volume_name(path):
+    name = os.path.basename(path)
+    for extension in NIFTI_EXTENSIONS:
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def list_pairs(images, masks):
+    # image and mask volumes have the same file names
+    pairs = []
+    for name in sorted(os.listdir(images)):
+        if not name.endswith(NIFTI_EXTENSIONS):
+            continue
+        mask = os.path.join(masks, name)
+        if not os.path.exists(mask):
+            print(f'Mask of \"{name}\" not exists')
+            continue
+        pairs.append((os.path.join(images, name), mask))
+    return pairs
+
+
+def checksum(paths, chunk_size=2 ** 20):
+    hasher = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def read_slices(image_path, mask_path, settings):
+    # windowed image and mask slices with uniform flags, volumes are read by chunks of slices,
+    # compressed files are kept open, so every chunk continues decompression of previous one
+    import nibabel as nib  # only for NIfTI inputs
+
+    image = nib.load(image_path, mmap=True, keep_file_open=image_path.endswith('.gz'))
+    mask = nib.load(mask_path, mmap=True, keep_file_open=mask_path.endswith('.gz'))
+    if image.shape[:3] != mask.shape[:3]:
+        raise ValueError(f'Image shape {image.shape} and mask shape {mask.shape} differ')
+    chunk = settings['chunk_slices']
+    low = settings['window_center'] - settings['window_width'] // 2
+    high = settings['window_center'] + settings['window_width'] // 2
+    for start in range(0, image.shape[-1], chunk):
+        raw = np.moveaxis(np.asarray(image.dataobj[..., start:start + chunk]), -1, 0)
+        # slice is blank if its raw values are one value after windowing
+        axes = tuple(range(1, raw.ndim))
+        uniform = np.clip(raw.min(axis=axes), low, high) == np.clip(raw.max(axis=axes), low, high)
+        images = window_volume(raw, settings['window_center'], settings['window_width'])
+        masks = np.moveaxis(np.asarray(mask.dataobj[..., start:start + chunk]), -1, 0)
+        masks = np.rint(masks).astype(np.uint8)
+        for i in range(len(images)):
+            yield start + i, images[i], masks[i], uniform[i]
+
+
+def convert_volume(job, output, settings):
+    # one pair of volumes in worker process, slices are written while next ones are read
+    patient, image_path, mask_path = job
+    start = time.perf_counter()
+    slices = 0
+    try:
+        if settings['format'] == 'shards':
+            writer = ShardWriter(os.path.join(output, 'parts', str(patient)))
+            writer.new_patient()
+            for i, image, mask, uniform in read_slices(image_path, mask_path, settings):
+                writer.add(f'{patient}_{i}.npz', image, mask, uniform)
+                slices += 1
+            writer.close()
+        else:
+            for i, image, mask, _ in read_slices(image_path, mask_path, settings):
+                np.savez(os.path.join(output, f'{patient}_{i}.npz'), image=image, mask=mask)
+                slices += 1
+    except Exception as e:
+        return job, slices, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+    return job, slices, time.perf_counter() - start, None
+
+
+def remove_outputs(output, patient, entry, settings):
+    # outputs of changed volume are replaced
+    if settings['format'] == 'shards':
+        shutil.rmtree(os.path.join(output, 'parts', str(patient)), ignore_errors=True)
+        return
+    for i in range(entry.get('slices', 0)):
+        path = os.path.join(output, f'{patient}_{i}.npz')
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def run(args):
+    settings = dict(window_center=args.window_center, window_width=args.window_width, format=args.format,
+                    chunk_slices=args.chunk_slices)
+    output_settings = dict(window_center=args.window_center, window_width=args.window_width, format=args.format)
+    output = os.path.join(args.data_folder, args.dataset_name)
+    if args.format == 'shards':
+        output = os.path.join(args.data_folder, 'shards', args.dataset_name + '_parts')
+    if not os.path.exists(output):
+        os.makedirs(output)
+
+    # patients keep their numbers between runs, new volumes get next ones
+    manifest_path = os.path.join(args.data_folder, args.dataset_name + MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    next_patient = max([entry['patient'] for entry in manifest.values()], default=0) + 1
+
+    pairs = list_pairs(args.images, args.masks)
+    jobs, checksums = [], {}
+    start = time.perf_counter()
+    for image_path, mask_path in pairs:
+        # files are hashed again only if their sizes or modification times changed
+        name = volume_name(image_path)
+        entry = manifest.get(name)
+        stats = [[os.path.getsize(path), int(os.path.getmtime(path))] for path in [image_path, mask_path]]
+        if entry is not None and entry.get('stats') == stats and 'checksum' in entry:
+            checksums[name] = (entry['checksum'], stats)
+        else:
+            checksums[name] = (checksum([image_path, mask_path]), stats)
+        if entry is not None and entry.get('checksum') == checksums[name][0] \
+                and entry.get('settings') == output_settings and not args.overwrite:
+            continue
+        if entry is None:
+            entry = manifest[name] = dict(patient=next_patient)
+            next_patient += 1
+        else:
+            remove_outputs(output, entry['patient'], entry, settings)
+        jobs.append((entry['patient'], image_path, mask_path))
+    hashing = time.perf_counter() - start
+    print(f'Volumes: {len(pairs)}, unchanged {len(pairs) - len(jobs)}, checksums in {hashing:.1f}s')
+
+    # every volume is converted in its own process
+    names = {entry['patient']: name for name, entry in manifest.items()}
+    slices, failed = 0, 0
+    input_bytes = sum(os.path.getsize(path) for _, image_path, mask_path in jobs for path in [image_path, mask_path])
+    start = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(max(1, args.workers)) as pool:
+        convert = partial(convert_volume, output=output, settings=settings)
+        for i, (job, volume_slices, seconds, error) in enumerate(pool.imap_unordered(convert, jobs), 1):
+            name = names[job[0]]
+            if error is None:
+                manifest[name].update(checksum=checksums[name][0], stats=checksums[name][1], settings=output_settings,
+                                      slices=volume_slices)
+                slices += volume_slices
+                print(f'[{i}/{len(jobs)}] {name}: {volume_slices} slices, {seconds:.1f}s')
+            else:
+                manifest[name].pop('checksum', None)  # converted again on next run
+                failed += 1
+                print(f'[{i}/{len(jobs)}] {name}: failed, {error}')
+
+            # manifest is saved after every volume, so interrupted run is resumed
+            with open(manifest_path + '.tmp', 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(manifest_path + '.tmp', manifest_path)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    shard = shard_folder(args, args.dataset_name)
+    if args.format == 'shards' and (jobs or not os.path.exists(os.path.join(shard, INDEX))):
+        # patient parts are joined into one shard of dataset
+        parts = [os.path.join(output, 'parts', str(entry['patient']))
+                 for entry in sorted(manifest.values(), key=lambda entry: entry['patient']) if 'checksum' in entry]
+        merged = merge_shards([part for part in parts if os.path.exists(os.path.join(part, INDEX))], shard)
+        print(f'Shard: {merged} slices to {shard}')
+
+    print(f'Converted: {len(jobs) - failed} volumes, {failed} failed, {slices} slices in {elapsed:.1f}s')
+    print(f'Throughput: {slices / elapsed:.2f} slices/s, {(len(jobs) - failed) / elapsed:.3f} volumes/s, '
+          f'{input_bytes / 2 ** 20 / elapsed:.1f} MB/s of input')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NIfTI image and mask volumes to training slices')
+    parser.add_argument('--images', required=True, help='folder of NIfTI images')
+    parser.add_argument('--masks', required=True, help='folder of NIfTI masks with the same file names')
+    parser.add_argument('--data_folder', required=True, help='cfg.data_folder of training')
+    parser.add_argument('--dataset_name', required=True, help='cfg.dataset_name of training')
+    parser.add_argument('--format', default='npz', choices=['npz', 'shards'],
+                        help='npz slices or packed shard (see src/shards.py)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--window_center', type=int, default=ProductionConfig.window_center)
+    parser.add_argument('--window_width', type=int, default=ProductionConfig.window_width)
+    parser.add_argument('--chunk_slices', type=int, default=16, help='slices read from volume at once')
+    parser.add_argument('--overwrite', action='store_true', help='convert unchanged volumes too')
+    run(parser.parse_args())
@@ -1,34 +1,90 @@
 from utils import get_model
 from data_functions import get_transforms
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, get_worker_info
 import cv2
 import torch
 import numpy as np
-import nibabel as nib
 import random
 import string
 import os
-from config import BinaryModelConfig, MultiModelConfig, LungsModelConfig
-from PIL import Image, ImageFont, ImageDraw
-
-
-def get_setup():
-    # preparing
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    models = []
+from functools import partial
+from cache import PredictionCache
+from engine import ModelRunner, LazyModels, prefetch, predict_argmax
+from fused import FusedUnetPlusPlus, FusedRunner
+from precision import apply_precision, check_precision
+from backends import load_exported, predict_exported, EXTENSIONS
+from nifti import NiftiSlices
+from tta import TTAPredict, tta_views
+from config import BinaryModelConfig, MultiModelConfig, LungsModelConfig, FusedModelConfig, ProductionConfig
+
+
+def get_production_transforms():
+    # test transforms of every model
     transforms = []
-
-    # setup for every model
     for cfg in [BinaryModelConfig, MultiModelConfig, LungsModelConfig]:
-        # getting model
-        model = get_model(cfg)(cfg)
-        model.load_state_dict(torch.load(cfg.best_dict, map_location=device))
-        model.eval()
-        models.append(model)
-
-        # getting transforms
         _, test_transforms = get_transforms(cfg)
         transforms.append(test_transforms)
+    return transforms
+
+
+def load_model(cfg, device, build=None):
+    # ready-to-run model is kept in model cache folder, so architecture isn't built again,
+    # unreadable cached model is built again from checkpoint
+    folder = ProductionConfig.model_cache_folder
+    if folder:
+        stat = os.stat(cfg.best_dict)
+        name = os.path.splitext(os.path.basename(cfg.best_dict))[0]
+        path = os.path.join(folder, f'{name}_{int(stat.st_mtime)}_{stat.st_size}.pth')
+        if os.path.exists(path):
+            try:
+                return torch.load(path, map_location=device).eval()
+            except Exception as e:
+                print(f'Cached model "{path}" is not loaded, {type(e).__name__}: {e}')
+
+    model = build(cfg) if build is not None else get_model(cfg)(cfg)
+    model.load_state_dict(torch.load(cfg.best_dict, map_location=device))
+    model.to(device)
+    model.eval()
+    if folder:
+        # file appears complete, so workers building the same model never read half-written one
+        os.makedirs(folder, exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.tmp'
+        torch.save(model, temporary)
+        os.replace(temporary, path)
+    return model
+
+
+def load_production_model(cfg, device, precision, calibration):
+    model = load_model(cfg, device)
+    return apply_precision([model], precision, device, calibration)[0]
+
+
+def get_setup(fused=None, precision=None, calibration=None, backend=None, lazy=None):
+    # preparing
+    fused = ProductionConfig.fused_model if fused is None else fused
+    precision = precision or ProductionConfig.precision
+    backend = backend or ProductionConfig.backend
+    lazy = ProductionConfig.lazy_models if lazy is None else lazy
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    transforms = get_production_transforms()
+
+    # precision is checked before lazy models are loaded, so wrong setup fails here and not on first study
+    check_precision(precision, device, calibration, fused)
+
+    # exported models don't need architectures and state dicts
+    if backend != 'eager':
+        if fused or precision != 'fp32':
+            raise ValueError(f'Backend \"{backend}\" supports only separate models in fp32')
+        models = load_exported(backend, ProductionConfig.export_folder, device)
+    elif fused:  # shared encoder model replaces list of models
+        models = load_model(FusedModelConfig, device, build=FusedUnetPlusPlus)
+        models = apply_precision(models, precision, device, calibration)
+    else:  # setup for every model, it is loaded when prediction needs it
+        models = LazyModels([partial(load_production_model, cfg, device, precision, calibration)
+                             for cfg in [BinaryModelConfig, MultiModelConfig, LungsModelConfig]])
+
+    if not lazy and not fused:
+        list(models)
     return models, transforms
 
 
@@ -37,6 +93,8 @@ def generate_folder_name():
 
 
 def make_legend(image, annotation):
+    from PIL import Image, ImageFont, ImageDraw  # only for legends
+
     # rgb_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
     rgb_image = np.round(image).astype(np.uint8)
     image = Image.fromarray(rgb_image)
@@ -69,8 +127,9 @@ def make_legend(image, annotation):
     return np.asarray(new_image)
 
 
-def data_to_paths(data, save_folder):
-    all_paths = []
+def data_to_studies(data, save_folder, export_slices=False):
+    # every study is pair of slice paths and volume (None for png/jpg images)
+    studies = []
     create_folder(save_folder)
     if not os.path.isdir(data):  # single file
         data = [data]
@@ -78,89 +137,82 @@ def data_to_paths(data, save_folder):
         data = [os.path.join(data, x) for x in os.listdir(data)]
 
     for path in data:
-        if not os.path.exists(path):  # path not exists
-            print(f'Path \"{path}\" not exists')
-            continue
-        # reformatting by type
-        if path.endswith('.png') or path.endswith('.jpg') or path.endswith('.jpeg'):
-            all_paths.append(path)
-        elif path.endswith('.nii') or path.endswith('.nii.gz'):
-            # NIftI format will be png format in folder "slices"
-            if not os.path.exists(os.path.join(save_folder, 'slices')):
-                os.mkdir(os.path.join(save_folder, 'slices'))
-
-            paths = []
-
-            # NIftI to numpy arrays
-            nii_name = path.split('\\')[-1].split('.')[0]
-            images = nib.load(path)
-            images = np.array(images.dataobj)
-            images = np.moveaxis(images, -1, 0)
-
-            for i, image in enumerate(images):
-                image = window_image(image)  # windowing
-                image += abs(np.min(image))
-                image = image / np.max(image)
-                # saving like png image
-                image_path = os.path.join(save_folder, 'slices', nii_name + '_' + str(i) + '.png')
-                cv2.imwrite(image_path, image * 255)
-
-                paths.append(image_path)
-            all_paths.extend(paths)
-        else:
-            print(f'Path \"{path}\" is not supported format')
+        study = path_to_study(path, save_folder, export_slices)
+        if study is not None:
+            studies.append(study)
+    return studies
+
+
+def path_to_study(path, save_folder, export_slices=False):
+    if not os.path.exists(path):  # path not exists
+        print(f'Path \"{path}\" not exists')
+        return None
+    # reformatting by type
+    if path.endswith('.png') or path.endswith('.jpg') or path.endswith('.jpeg'):
+        return [path], None
+    if path.endswith('.nii') or path.endswith('.nii.gz'):
+        # NIftI slices are named like png files in folder "slices"
+        nii_name = path.split('\\')[-1].split('.')[0]
+        volume = load_nifti(path)
+        paths = [os.path.join(save_folder, 'slices', nii_name + '_' + str(i) + '.png') for i in range(len(volume))]
+
+        # png files are written only by request
+        if export_slices:
+            create_folder(os.path.join(save_folder, 'slices'))
+            save_slices(volume, paths)
+        return paths, volume
+    print(f'Path \"{path}\" is not supported format')
+    return None
+
+
+def data_to_paths(data, save_folder):
+    all_paths = []
+    for paths, _ in data_to_studies(data, save_folder, export_slices=True):
+        all_paths.extend(paths)
     return all_paths
 
 
-def window_image(image, window_center=-600, window_width=1500):
-    img_min = window_center - window_width // 2
-    img_max = window_center + window_width // 2
-    window_image = image.copy()
-    window_image[window_image < img_min] = img_min
-    window_image[window_image > img_max] = img_max
-    return window_image
+def load_nifti(path):
+    # slices are windowed to [0;1] range and loaded lazily by chunks
+    return NiftiSlices(path, ProductionConfig.window_center, ProductionConfig.window_width,
+                       ProductionConfig.nifti_chunk_slices)
+
 
+def save_slices(volume, paths):
+    # saving like png images
+    for image, image_path in zip(volume, paths):
+        cv2.imwrite(image_path, image * 255)
 
-def read_files(files):
+
+def read_files(files, export_slices=False):
     # creating folder for user
     folder_name = generate_folder_name()
     path = 'images/' + folder_name
     if not os.path.exists(path):
         os.mkdir(path)
 
-    paths = []
+    studies = []
     for file in files:
-        paths.append([])
         # if NIfTI we should get slices
         if file.name.endswith('.nii') or file.name.endswith('.nii.gz'):
             # saving file from user
             nii_path = path + file.name
             open(nii_path, 'wb').write(file.getvalue())
 
-            # loading
-            images = nib.load(nii_path)
-            images = np.array(images.dataobj)
-            images = np.moveaxis(images, -1, 0)
-
-            os.remove(nii_path)  # clearing
-
-            for i, image in enumerate(images):  # saving every slice in NIftI
-                # windowing
-                image = window_image(image)
-                image += abs(np.min(image))
-                image = image / np.max(image)
+            # loading, file is kept until the study is processed
+            volume = load_nifti(nii_path)
 
-                # saving
-                image_path = path + file.name.split('.')[0] + f'_{i}.png'
-                cv2.imwrite(image_path, image * 255)
-                paths[-1].append(image_path)
+            paths = [path + file.name.split('.')[0] + f'_{i}.png' for i in range(len(volume))]
+            if export_slices:  # saving every slice in NIftI
+                save_slices(volume, paths)
+            studies.append((paths, volume))
 
         else:
             with open(path + file.name, 'wb') as f:
                 f.write(file.getvalue())
 
-            paths[-1].append(path + file.name)
-    return paths, folder_name
+            studies.append(([path + file.name], None))
+    return studies, folder_name
 
 
 def create_folder(path):
@@ -168,70 +220,392 @@ def create_folder(path):
         os.mkdir(path)
 
 
-def get_predictions(paths, models, transforms, multi_class=True):
+MODEL_OUTPUTS = ('binary', 'multi', 'lung')  # order of models from get_setup
+
+
+def predict_missing(X, runner, outputs, cached, lungs_first=None):
+    # cached is list of per-slice dicts from cache, only absent model outputs are predicted,
+    # argmax maps of chunk stay on device
+    if lungs_first and 'lung' in outputs and len(outputs) > 1:
+        return predict_in_lungs(X, runner, outputs, cached, crop=lungs_first == 'crop')
+
+    jobs, missing_slices = [], []
+    for index, name in enumerate(MODEL_OUTPUTS):
+        if name not in outputs:
+            continue
+        missing = [i for i, slice_maps in enumerate(cached) if name not in slice_maps]
+        if missing:
+            jobs.append((index, X if len(missing) == len(X) else X[missing]))
+        missing_slices.append((name, missing))
+    predicted = dict(zip([name for name, missing in missing_slices if missing], runner.run(jobs)))
+
+    maps, computed = {}, {}
+    for name, missing in missing_slices:
+        if len(missing) == len(X):
+            maps[name] = predicted[name].to(X.device)
+        else:
+            known = [i for i in range(len(X)) if i not in missing]
+            maps[name] = torch.empty((len(X),) + tuple(X.shape[2:]), dtype=torch.uint8, device=X.device)
+            maps[name][known] = torch.from_numpy(np.stack([cached[i][name] for i in known])).to(X.device)
+            if missing:
+                maps[name][missing] = predicted[name].to(X.device)
+        if missing:
+            computed[name] = (missing, predicted[name])
+    return maps, computed
+
+
+def lung_windows(lung, margin=None, multiple=32):
+    # one crop size for all slices: biggest lung box with margin rounded up to multiple of 32 (UNet++ input),
+    # window of every slice is centered on its lung box and kept inside slice, top left corners are returned
+    margin = ProductionConfig.lung_crop_margin if margin is None else margin
+    height, width = lung.shape[1:]
+    rows = lung.any(2).to(torch.uint8)
+    cols = lung.any(1).to(torch.uint8)
+    boxes = torch.stack([rows.argmax(1), height - rows.flip(1).argmax(1),
+                         cols.argmax(1), width - cols.flip(1).argmax(1)], 1).tolist()
+    box_height = max(bottom - top for top, bottom, _, _ in boxes) + 2 * margin
+    box_width = max(right - left for _, _, left, right in boxes) + 2 * margin
+    crop_height = min(height, -(-box_height // multiple) * multiple)
+    crop_width = min(width, -(-box_width // multiple) * multiple)
+    corners = [(min(max((top + bottom - crop_height) // 2, 0), height - crop_height),
+                min(max((left + right - crop_width) // 2, 0), width - crop_width))
+               for top, bottom, left, right in boxes]
+    return corners, (crop_height, crop_width)
+
+
+def crop_index(corners, size, device):
+    # rows and columns of crop windows for advanced indexing of (slices, height, width) tensors
+    corners = torch.tensor(corners, device=device)
+    rows = corners[:, :1] + torch.arange(size[0], device=device)
+    cols = corners[:, 1:] + torch.arange(size[1], device=device)
+    slices = torch.arange(len(corners), device=device).view(-1, 1, 1)
+    return slices, rows[:, :, None], cols[:, None, :]
+
+
+def predict_in_lungs(X, runner, outputs, cached, crop=False):
+    # lung model runs first, disease models only on slices with lungs,
+    # so skipped slices are exactly the ones with empty lung map and their disease maps are empty,
+    # with crop disease models see only fixed size window around lungs that is pasted back
+    maps, computed = predict_missing(X, runner, ('lung',), cached)
+    keep = torch.nonzero(maps['lung'].flatten(1).any(1)).flatten().tolist()
+    disease = tuple(name for name in outputs if name != 'lung')
+    shape = (len(X),) + tuple(X.shape[2:])
+    if not keep:
+        maps.update({name: torch.zeros(shape, dtype=torch.uint8, device=X.device) for name in disease})
+        return maps, computed
+
+    X_keep = X if len(keep) == len(X) else X[keep]
+    cached_keep = [cached[i] for i in keep]
+    index = None
+    if crop:
+        corners, size = lung_windows(maps['lung'][keep])
+        if size != tuple(X.shape[2:]):
+            index = crop_index(corners, size, X.device)
+            X_keep = X_keep[:, 0][index].unsqueeze(1)
+            cached_keep = [{name: slice_maps[name][top:top + size[0], left:left + size[1]]
+                            for name in disease if name in slice_maps}
+                           for slice_maps, (top, left) in zip(cached_keep, corners)]
+    disease_maps, disease_computed = predict_missing(X_keep, runner, disease, cached_keep)
+
+    # outputs of skipped slices aren't model outputs, so only predicted slices are returned for cache
+    for name in disease:
+        if index is None and len(keep) == len(X):
+            maps[name] = disease_maps[name]
+        else:
+            maps[name] = torch.zeros(shape, dtype=torch.uint8, device=X.device)
+            if index is None:
+                maps[name][keep] = disease_maps[name]
+            else:
+                # cached maps are full size, windows of them are pasted back unchanged
+                known = [i for i in keep if name in cached[i]]
+                if known:
+                    maps[name][known] = torch.from_numpy(np.stack([cached[i][name] for i in known])).to(X.device)
+                keep_maps = maps[name][keep]
+                keep_maps[index] = disease_maps[name]
+                maps[name][keep] = keep_maps
+        if name in disease_computed:
+            missing = [keep[i] for i in disease_computed[name][0]]
+            computed[name] = (missing, maps[name][missing])
+    return maps, computed
+
+
+def combine_predictions(maps, multi_class=True):
+    pred = maps['binary'].float()
+    lung = maps['lung'].float()
+
+    # if multi class we should use both models to predict
+    if multi_class:
+        multi_pred = (maps['multi'] % 3)  # model on trained on 3 classes but using only 2
+        pred = pred + (multi_pred == 2)  # ground-glass from binary model and consolidation from second
+    return pred, lung
+
+
+def lesion_counts(pred, lung):
+    # pixels of every (lesion class, lung side) pair, shape (slices, 3, 3), one bincount for the whole batch
+    n = len(pred)
+    offsets = torch.arange(n, device=pred.device).view(-1, 1, 1) * 9
+    index = pred.long() * 3 + lung.long() + offsets
+    return torch.bincount(index.flatten(), minlength=n * 9).view(n, 3, 3)
+
+
+def lesion_stats(counts, multi_class=True):
+    # percents of lesions in left and right lungs, empty lung has 0%,
+    # raw counts are kept for study aggregation
+    lung_pixels = counts.sum(0)
+
+    def percent(lesion, side):
+        return float(counts[lesion, side] / lung_pixels[side] * 100) if lung_pixels[side] else 0.0
+
+    stats = dict(lung_left=int(lung_pixels[1]), lung_right=int(lung_pixels[2]), counts=counts)
+    if multi_class:
+        stats.update(ground_glass_left=percent(1, 1), ground_glass_right=percent(1, 2),
+                     consolidation_left=percent(2, 1), consolidation_right=percent(2, 2))
+    else:
+        stats.update(disease_left=percent(1, 1), disease_right=percent(1, 2))
+    return stats
+
+
+_caches = {}
+
+
+def file_signature(path):
+    # path with modification time and size, so retrained checkpoint at the same path is another model
+    if not os.path.exists(path):
+        return path
+    stat = os.stat(path)
+    return f'{path}:{int(stat.st_mtime)}:{stat.st_size}'
+
+
+def get_cache(folder=None, fused=None, precision=None, backend=None, tta=None):
+    # shared cache of model outputs, models are identified by checkpoint files, precision and backend
+    fused = ProductionConfig.fused_model if fused is None else fused
+    precision = precision or ProductionConfig.precision
+    backend = backend or ProductionConfig.backend
+    tta = tta or ProductionConfig.tta
+    if not ProductionConfig.cache_size:
+        return None
+    if backend != 'eager':  # exported models are their artifact files
+        files = [os.path.join(ProductionConfig.export_folder, name + EXTENSIONS[backend]) for name in MODEL_OUTPUTS]
+    else:
+        configs = [FusedModelConfig] if fused else [BinaryModelConfig, MultiModelConfig, LungsModelConfig]
+        files = [cfg.best_dict for cfg in configs]
+    salt = ';'.join([file_signature(path) for path in files] + [precision, backend])
+    if ProductionConfig.skip_empty_slices and ProductionConfig.lung_crop and not fused and backend == 'eager':
+        salt += ';crop'  # disease outputs of lung crops
+    if tta != 'none' and not fused:
+        salt += ';tta=' + tta
+    if salt not in _caches:
+        folder = folder or ProductionConfig.cache_folder
+        _caches[salt] = PredictionCache(ProductionConfig.cache_size, folder, salt)
+    return _caches[salt]
+
+
+def is_out_of_memory(error):
+    # CUDA and CPU allocator errors
+    message = str(error)
+    return isinstance(error, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+def reopen_volume(worker_id):
+    # forked workers would share open file of compressed NIfTI volume
+    volume = getattr(get_worker_info().dataset, 'volume', None)
+    if isinstance(volume, NiftiSlices):
+        volume.open()
+
+
+def make_dataset(paths, volume=None, transform=None):
+    if volume is not None:  # slices straight from memory
+        return ProductionVolumeDataset(volume, transform=transform)
+    return ProductionCovid19Dataset(paths, transform=transform)
+
+
+def get_predictions(paths, models, transforms, multi_class=True, batch_size=None, num_workers=None, volume=None,
+                    cache=None, stats=None, tta=None):
+    # stats dict gets numbers of predicted and skipped (without lungs) slices,
+    # tta is policy from ProductionConfig.tta_policies
     # preparing
-    binary_model, multi_model, lung_model = models
+    outputs = MODEL_OUTPUTS if multi_class else ('binary', 'lung')
+    batch_size = batch_size or ProductionConfig.batch_size
+    num_workers = ProductionConfig.num_workers if num_workers is None else num_workers
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    dataloader = DataLoader(ProductionCovid19Dataset(paths, transform=transforms[0]), batch_size=1, drop_last=False)
-
-    # prediction
-    for X, _ in dataloader:
-        X = X.to(device)
-        X = X / torch.max(X)
-
-        with torch.no_grad():
-            pred = binary_model(X)
-            lung = lung_model(X)
-
-            img = X.squeeze().cpu()
-            pred = pred.squeeze().cpu()
-            pred = torch.argmax(pred, 0).float()
-            lung = lung.squeeze().cpu()
-            lung = torch.argmax(lung, 0).float()
-
-            # if multi class we should use both models to predict
-            if multi_class:
-                multi_output = multi_model(X)
-                multi_pred = multi_output.squeeze().cpu()
-                multi_pred = torch.argmax(multi_pred, 0).float()
-                multi_pred = (multi_pred % 3)  # model on trained on 3 classes but using only 2
-                pred = pred + (multi_pred == 2)  # ground-glass from binary model and consolidation from second
-            pred = pred  # to [0;1] range
-            yield img.numpy(), pred.numpy(), lung.numpy()
+    dataset = make_dataset(paths, volume, transforms[0])
+    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, drop_last=False,
+                            pin_memory=device.type == 'cuda', worker_init_fn=reopen_volume)
+    runner = make_runner(models, device, tta)
+
+    # prediction, next batch is read while models are busy
+    try:
+        yield from predict_batches(prefetch(dataloader, ProductionConfig.prefetch_batches), runner, outputs,
+                                   multi_class, batch_size, device, cache, lungs_first(runner), stats)
+    finally:
+        runner.close()
+
+
+def lungs_first(runner):
+    # 'skip' runs lung model before disease models that skip slices without lungs,
+    # 'crop' also crops lung region for them, None runs all models at once;
+    # fused model would run shared encoder twice, exported models normalize input themselves,
+    # so crop would be scaled by its own maximum instead of slice maximum
+    if not ProductionConfig.skip_empty_slices or isinstance(runner, FusedRunner):
+        return None
+    if ProductionConfig.lung_crop and getattr(runner.models, 'backend', 'eager') == 'eager':
+        return 'crop'
+    return 'skip'
+
+
+def make_runner(models, device, tta=None):
+    if isinstance(models, FusedUnetPlusPlus):
+        return FusedRunner(models, device)
+    predict = predict_exported if getattr(models, 'backend', 'eager') != 'eager' else predict_argmax
+
+    # augmented views are predicted only by models from tta_models
+    views = tta_views(tta)
+    if views:
+        predict = [TTAPredict(views) if name in ProductionConfig.tta_models else predict for name in MODEL_OUTPUTS]
+    return ModelRunner(models, device, ProductionConfig.concurrent_models, predict=predict)
+
+
+def restore_index(shape, size, device):
+    # source pixel of every native pixel like cv2.INTER_NEAREST resize from model size,
+    # old orientation fix of masks (transpose, counter-clockwise rotation and vertical flip)
+    # maps every pixel to itself, so rows and columns are only scaled
+    rows = torch.arange(shape[0], device=device) * size[0] // shape[0]
+    cols = torch.arange(shape[1], device=device) * size[1] // shape[1]
+    return rows.view(-1, 1), cols
+
+
+def restore_native(tensors, shapes=None):
+    # (slices, height, width) tensors are brought back to native shapes of slices,
+    # one gather for every distinct shape in chunk, pairs of slice indices and restored tensors are yielded
+    n = len(tensors[0])
+    if shapes is None:
+        yield list(range(n)), tensors
+        return
+    groups = {}
+    for i, shape in enumerate(shapes.tolist()):
+        groups.setdefault(tuple(shape), []).append(i)
+
+    size = tuple(tensors[0].shape[-2:])
+    for shape, indices in groups.items():
+        selected = tensors if len(indices) == n else [x[indices] for x in tensors]
+        if shape == size:
+            yield indices, selected
+            continue
+        rows, cols = restore_index(shape, size, tensors[0].device)
+        yield indices, [x[:, rows, cols] for x in selected]
+
+
+def predict_batches(batches, runner, outputs, multi_class, batch_size, device, cache=None, lungs_first=None,
+                    stats=None):
+    # masks and lesion counts are computed on device, masks are restored to native resolution,
+    # one transfer per chunk of slices with the same shape
+    for img, maps, shapes in predict_maps(batches, runner, outputs, batch_size, device, cache, lungs_first, stats):
+        pred, lung = combine_predictions(maps, multi_class)
+        counts = lesion_counts(pred, lung).cpu().numpy()
+        results = [None] * len(img)
+        for indices, restored in restore_native([img, pred, lung], shapes):
+            restored_img, restored_pred, restored_lung = [x.cpu().numpy() for x in restored]
+            for j, i in enumerate(indices):
+                results[i] = (restored_img[j], restored_pred[j], restored_lung[j], counts[i])
+        yield from results
+
+
+def predict_maps(batches, runner, outputs, batch_size, device, cache=None, lungs_first=None, stats=None):
+    # normalized slices, dict of argmax maps of every model and native shapes (None if unknown)
+    # for chunks of batches, all on device
+    if stats is not None:
+        stats.setdefault('slices', 0)
+        stats.setdefault('skipped', 0)
+    for X, shapes in batches:
+        keys = [cache.key(x) for x in X.numpy()] if cache is not None else None
+        X = X.to(device, non_blocking=True)
+        X = X / torch.amax(X, dim=(1, 2, 3), keepdim=True).clamp(min=1e-9)  # every slice to [0;1], blank stays 0
+
+        # batch is split into chunks, chunk size is halved while memory runs out
+        start = 0
+        while start < len(X):
+            chunk = X[start:start + batch_size]
+            chunk_keys = keys[start:start + len(chunk)] if cache is not None else None
+            if cache is not None:
+                cached = [cache.get(key) for key in chunk_keys]
+            else:
+                cached = [{} for _ in range(len(chunk))]
+            try:
+                maps, computed = predict_missing(chunk, runner, outputs, cached, lungs_first)
+            except RuntimeError as e:
+                if not is_out_of_memory(e) or batch_size == 1:
+                    raise
+                torch.cuda.empty_cache()
+                batch_size = max(1, batch_size // 2)
+                print(f'Out of memory, batch size reduced to {batch_size}')
+                continue
+
+            # only new outputs are copied for cache
+            if cache is not None:
+                updates = [{} for _ in range(len(chunk))]
+                for name, (missing, output) in computed.items():
+                    for i, output_map in zip(missing, output.cpu().numpy()):
+                        updates[i][name] = output_map
+                for key, slice_maps in zip(chunk_keys, updates):
+                    if slice_maps:
+                        cache.update(key, slice_maps)
+            if stats is not None:
+                stats['slices'] += len(chunk)
+                if lungs_first and len(outputs) > 1:
+                    stats['skipped'] += int((~maps['lung'].flatten(1).bool().any(1)).sum())
+            yield chunk[:, 0], maps, shapes[start:start + len(chunk)] if shapes is not None else None
+            start += len(chunk)
+
+
+def save_mask(img, annotation, path, save_folder, show_legend=False):
+    # annotation and mask image named by slice path
+    name = path.split('\\')[-1].split('.')[0].split('/')[-1]
+    annotation_path = os.path.join(save_folder, 'annotations', name + '_annotation.txt')
+    with open(annotation_path, mode='w') as f:
+        f.write(annotation)
+
+    mask_path = os.path.join(save_folder, 'segmentations', name + '_mask.png')
+    if show_legend:
+        img = make_legend(img, annotation)
+    if not cv2.imwrite(mask_path, img):
+        raise OSError(f'Mask \"{mask_path}\" is not written')
+    return mask_path, annotation_path
 
 
 def combo_with_lungs(disease, lungs):
     return disease * (lungs == 1), disease * (lungs == 2)
 
 
-def make_masks(paths, models, transforms, multi_class=True):
-    for path, (img, pred, lung) in zip(paths, get_predictions(paths, models, transforms, multi_class)):
-        lung_left = (lung == 1)
-        lung_right = (lung == 2)
-        not_disease = (pred == 0)
+def make_masks(paths, models, transforms, multi_class=True, batch_size=None, num_workers=None, volume=None,
+               cache=None, predictions=None):
+    # predictions can come from inference server instead of local models
+    if predictions is None:
+        predictions = get_predictions(paths, models, transforms, multi_class, batch_size, num_workers, volume, cache)
+    for path, (img, pred, lung, counts) in zip(paths, predictions):
+        stats = lesion_stats(counts, multi_class)
+        gray = np.round(img * 255).astype(np.uint8)
+        gray[pred != 0] = 0
+        lesion = np.uint8(255)
         if multi_class:
             consolidation = (pred == 2)  # red channel
             ground_glass = (pred == 1)  # green channel
 
-            img = np.array([np.zeros_like(img), ground_glass, consolidation]) + img * not_disease
+            # BGR image at native resolution
+            img = np.stack([gray, np.where(ground_glass, lesion, gray), np.where(consolidation, lesion, gray)], axis=-1)
 
             annotation = f'              left   |   right\n' \
-                         f' Ground-glass - {np.sum(ground_glass * lung_left) / np.sum(lung_left) * 100:.1f}% | {np.sum(ground_glass * lung_right) / np.sum(lung_right) * 100:.1f}%\n' \
-                         f'Consolidation - {np.sum(consolidation * lung_left) / np.sum(lung_left) * 100:.1f}% | {np.sum(consolidation * lung_right) / np.sum(lung_right) * 100:.1f}%'
+                         f' Ground-glass - {stats["ground_glass_left"]:.1f}% | {stats["ground_glass_right"]:.1f}%\n' \
+                         f'Consolidation - {stats["consolidation_left"]:.1f}% | {stats["consolidation_right"]:.1f}%'
         else:
             # disease percents
             disease = (pred == 1)
 
             annotation = f'              left   |   right\n' \
-                         f'Disease - {np.sum(disease * lung_left) / np.sum(lung_left) * 100:.1f}%  |  {np.sum(disease * lung_right) / np.sum(lung_right) * 100:.1f}%'
-
-            img = np.array([np.zeros_like(img), disease, disease]) + img * not_disease
+                         f'Disease - {stats["disease_left"]:.1f}%  |  {stats["disease_right"]:.1f}%'
 
-        img = img.swapaxes(0, -1)
-        img = np.round(img * 255)
-        img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
-        img = cv2.flip(img, 0)
-        yield img, annotation, path
+            disease = np.where(disease, lesion, gray)
+            img = np.stack([gray, disease, disease], axis=-1)
+        yield img, annotation, path, stats
 
 
 class ProductionCovid19Dataset(Dataset):
@@ -247,9 +621,29 @@ class ProductionCovid19Dataset(Dataset):
         path = self.paths[index]
         image = cv2.imread(path)
         image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        shape = torch.tensor(image.shape[:2])  # native resolution for masks
         if self.transform:
             transformed = self.transform(image=image)
             image = transformed['image']
         image = torch.from_numpy(np.array([image], dtype=np.float))
         image = image.type(torch.FloatTensor)
-        return image, 'None'
+        return image, shape
+
+
+class ProductionVolumeDataset(Dataset):
+    def __init__(self, volume, transform=None):
+        self.volume = volume
+        self.transform = transform
+        self._len = len(volume)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        image = np.asarray(self.volume[index], dtype=np.float32)
+        shape = torch.tensor(image.shape[:2])  # native resolution for masks
+        if self.transform:
+            transformed = self.transform(image=image)
+            image = transformed['image']
+        image = torch.from_numpy(np.array([image], dtype=np.float32))
+        return image, shape
@@ -0,0 +1,86 @@
+import csv
+import json
+import os
+import numpy as np
+
+SIDES = ('left', 'right')
+CT_SCORES = (0, 25, 50, 75)  # lower bounds of lesion percent for CT-1..CT-4, CT-0 is healthy
+
+
+class StudyReport:
+    # study totals accumulated from lesion counts of every slice, masks are not kept
+    def __init__(self, name, multi_class=True, spacing=None, native_shape=None):
+        self.name = name
+        self.multi_class = multi_class
+        self.spacing = spacing  # mm of NIfTI voxel
+        self.native_shape = native_shape
+        self.counts = np.zeros((3, 3), dtype=np.int64)
+        self.slices = 0
+        self.lesion_slices = 0
+        self.lungless_slices = 0  # disease models are skipped on them with skip_empty_slices
+        self.voxel_ml = None
+
+    def update(self, counts):
+        # counts of (lesion class, lung side) pixels of one slice
+        self.counts += counts
+        self.slices += 1
+        self.lesion_slices += int(counts[1:, 1:].sum() > 0)
+        self.lungless_slices += int(counts[:, 1:].sum() == 0)
+
+        # counts are of model resolution maps, so voxel is scaled by native and model pixels ratio
+        if self.voxel_ml is None and self.spacing is not None:
+            native_pixels = self.native_shape[0] * self.native_shape[1]
+            self.voxel_ml = float(np.prod(self.spacing[:3])) * native_pixels / counts.sum() / 1000
+
+    def result(self):
+        classes = dict(ground_glass=[1], consolidation=[2]) if self.multi_class else dict(disease=[1])
+        lung_pixels = self.counts.sum(0)
+        lungs = lung_pixels[1:].sum()
+
+        def ml(pixels):
+            return None if self.voxel_ml is None else float(pixels * self.voxel_ml)
+
+        def percent(pixels, total):
+            return float(pixels / total * 100) if total else 0.0
+
+        result = dict(name=self.name, slices=self.slices, lesion_slices=self.lesion_slices,
+                      lungless_slices=self.lungless_slices, multi_class=self.multi_class, voxel_ml=self.voxel_ml)
+        for i, side in enumerate(SIDES, 1):
+            result[f'lung_{side}_ml'] = ml(lung_pixels[i])
+        for name, lesions in classes.items():
+            pixels = self.counts[lesions].sum(0)
+            for i, side in enumerate(SIDES, 1):
+                result[f'{name}_{side}_ml'] = ml(pixels[i])
+                result[f'{name}_{side}_percent'] = percent(pixels[i], lung_pixels[i])
+            result[f'{name}_percent'] = percent(pixels[1:].sum(), lungs)
+
+        # severity by lesion percent of both lungs
+        result['lesion_percent'] = percent(self.counts[1:, 1:].sum(), lungs)
+        result['ct_score'] = int(sum(result['lesion_percent'] > bound for bound in CT_SCORES))
+        return result
+
+    def save(self, folder):
+        result = self.result()
+        with open(os.path.join(folder, self.name + '.json'), 'w') as f:
+            json.dump(result, f, indent=2)
+        save_table([result], os.path.join(folder, self.name + '.csv'))
+        return result
+
+
+def save_table(results, path):
+    # one row per study, columns of binary and multi-class studies are merged
+    columns = []
+    for result in results:
+        columns.extend(column for column in result if column not in columns)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def load_result(folder, name):
+    path = os.path.join(folder, name + '.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,247 @@
+import argparse
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+import numpy as np
+import torch
+from config import ProductionConfig
+from production import get_setup, get_cache, load_nifti, make_dataset, make_runner, predict_maps, \
+    combine_predictions, lesion_counts, restore_native, lungs_first, MODEL_OUTPUTS
+
+RESULT_NAMES = ('img', 'pred', 'lung', 'counts')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class BatchingPredictor:
+    # slices of concurrent requests are merged into shared forward passes,
+    # batch is sent when it is full or its first slice waited max_wait seconds
+    def __init__(self, models, batch_size, max_wait, max_queue, cache=None):
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.runner = make_runner(models, self.device)
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.cache = cache
+        self.lungs_first = lungs_first(self.runner)
+        self.skip_stats = dict(slices=0, skipped=0)
+        self.queue = queue.Queue()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.slices = 0
+        self.seconds = 0
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, images, multi_class, shapes=None):
+        # images is (slices, 1, height, width) tensor, shapes is (slices, 2) tensor of native shapes,
+        # future for every slice
+        with self._lock:
+            if self._pending + len(images) > self.max_queue:
+                raise QueueFull(f'{self._pending} slices are waiting, limit is {self.max_queue}')
+            self._pending += len(images)
+        futures = []
+        for i, image in enumerate(images):
+            future = Future()
+            self.queue.put((image, multi_class, future, shapes[i] if shapes is not None else None))
+            futures.append(future)
+        return futures
+
+    def stats(self):
+        with self._lock:
+            pending = self._pending
+        return dict(pending=pending, batches=self.batches, slices=self.slices,
+                    mean_batch=self.slices / max(self.batches, 1),
+                    slices_per_second=self.slices / max(self.seconds, 1e-9),
+                    skipped=self.skip_stats['skipped'],
+                    skip_rate=self.skip_stats['skipped'] / max(self.skip_stats['slices'], 1))
+
+    def _collect(self):
+        items = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        with self._lock:
+            self._pending -= len(items)
+
+        # slices of timed out requests are skipped
+        return [item for item in items if item[2].set_running_or_notify_cancel()]
+
+    def _loop(self):
+        while True:
+            items = self._collect()
+            if not items:
+                continue
+
+            # one pass for every model needed by any request in batch
+            multi = any(item[1] for item in items)
+            outputs = MODEL_OUTPUTS if multi else ('binary', 'lung')
+            X = torch.stack([item[0] for item in items])
+            shapes = None if any(item[3] is None for item in items) else torch.stack([item[3] for item in items])
+            start = time.perf_counter()
+            try:
+                results = []
+                for img, maps, chunk_shapes in predict_maps([(X, shapes)], self.runner, outputs, self.batch_size,
+                                                            self.device, self.cache, self.lungs_first,
+                                                            self.skip_stats):
+                    flags = [item[1] for item in items[len(results):len(results) + len(img)]]
+                    results.extend(combine_requests(img, maps, flags, chunk_shapes))
+            except Exception as e:
+                for _, _, future, _ in items:
+                    future.set_exception(e)
+                continue
+            self.seconds += time.perf_counter() - start
+            self.batches += 1
+            self.slices += len(items)
+
+            for result, (_, _, future, _) in zip(results, items):
+                future.set_result(result)
+
+
+def combine_requests(img, maps, flags, shapes=None):
+    # every slice is combined in mode of its own request and restored to its native shape
+    results = [None] * len(flags)
+    for multi_class in set(flags):
+        pred, lung = combine_predictions(maps, multi_class)
+        counts = lesion_counts(pred, lung).cpu().numpy()
+        selected = [i for i, flag in enumerate(flags) if flag == multi_class]
+        tensors = [img, pred.to(torch.uint8), lung.to(torch.uint8)]
+        if len(selected) < len(flags):
+            tensors = [x[selected] for x in tensors]
+            shapes_selected = shapes[selected] if shapes is not None else None
+        else:
+            shapes_selected = shapes
+        for indices, restored in restore_native(tensors, shapes_selected):
+            restored_img, restored_pred, restored_lung = [x.cpu().numpy() for x in restored]
+            for j, i in enumerate(indices):
+                results[selected[i]] = (restored_img[j], restored_pred[j], restored_lung[j], counts[selected[i]])
+    return results
+
+
+class OpenVolumes:
+    # NIfTI volumes of recent requests stay open, client sends chunks of study one after another,
+    # so decompression of .nii.gz goes on from previous chunk instead of from start of file
+    def __init__(self, size=4):
+        self.size = size
+        self._volumes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path, start, stop):
+        # windowed slices of range, volume is read by one request at a time
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+        with self._lock:
+            if key not in self._volumes:
+                self._volumes[key] = (load_nifti(path), threading.Lock())
+                while len(self._volumes) > self.size:
+                    self._volumes.popitem(last=False)
+            self._volumes.move_to_end(key)
+            volume, lock = self._volumes[key]
+        with lock:
+            return volume.read(start, min(stop, len(volume)))
+
+
+_volumes = OpenVolumes()
+
+
+def load_request_slices(request, transform):
+    # request has list of image paths or NIfTI path with slices range
+    if 'nifti' in request:
+        slices = _volumes.read(request['nifti'], request.get('start', 0), request.get('stop', sys.maxsize))
+        dataset = make_dataset(None, slices, transform)
+        indices = range(len(slices))
+    else:
+        dataset = make_dataset(request['paths'], None, transform)
+        indices = range(len(request['paths']))
+    if not indices:
+        raise ValueError('Request has no slices')
+    images, shapes = zip(*[dataset[i] for i in indices])
+    return torch.stack(images), torch.stack(shapes)
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    predictor = None
+    transform = None
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            self.send_json({'error': 'not found'}, 404)
+            return
+        self.send_json(self.predictor.stats())
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/predict':
+            self.send_json({'error': 'not found'}, 404)
+            return
+        futures = []
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            images, shapes = load_request_slices(request, self.transform)
+            futures = self.predictor.submit(images, request.get('multi_class', True), shapes)
+            results = [future.result(timeout=ProductionConfig.server_timeout) for future in futures]
+        except QueueFull as e:
+            self.send_json({'error': str(e)}, 503)
+            return
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            self.send_json({'error': 'prediction timed out'}, 504)
+            return
+        except (KeyError, ValueError, OSError) as e:
+            self.send_json({'error': str(e)}, 400)
+            return
+
+        # slices of one request can have different native shapes, so arrays are kept per slice
+        buffer = io.BytesIO()
+        arrays = {f'{name}_{i}': value for i, result in enumerate(results) for name, value in zip(RESULT_NAMES, result)}
+        np.savez(buffer, slices=len(results), **arrays)
+        self.send_bytes(buffer.getvalue(), 'application/octet-stream')
+
+    def send_json(self, data, status=200):
+        self.send_bytes(json.dumps(data).encode(), 'application/json', status)
+
+    def send_bytes(self, data, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(host, port, batch_size=None, max_wait=None, max_queue=None):
+    models, transforms = get_setup()
+    InferenceHandler.predictor = BatchingPredictor(models, batch_size or ProductionConfig.batch_size,
+                                                   ProductionConfig.server_max_wait if max_wait is None else max_wait,
+                                                   max_queue or ProductionConfig.server_max_queue, get_cache())
+    InferenceHandler.transform = transforms[0]
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    print(f'Serving on http://{host}:{port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    url = urlparse(ProductionConfig.server_url)
+    parser = argparse.ArgumentParser(description='inference server keeping models in memory')
+    parser.add_argument('--host', default=url.hostname)
+    parser.add_argument('--port', type=int, default=url.port)
+    parser.add_argument('--batch_size', type=int, default=None, help='max slices in shared forward pass')
+    parser.add_argument('--max_wait', type=float, default=None, help='seconds to wait for batch to fill')
+    parser.add_argument('--max_queue', type=int, default=None, help='max waiting slices, requests over it get 503')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.batch_size, args.max_wait, args.max_queue)
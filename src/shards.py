@@ -0,0 +1,245 @@
+import argparse
+import os
+import time
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from utils import get_paths_1_dataset
+
+# dataset is packed into one shard: images and masks of every slice one after another
+# in raw files, index keeps offsets and shapes of slices and ranges of patients
+IMAGES = 'images.bin'
+MASKS = 'masks.bin'
+INDEX = 'index.npz'
+
+
+def is_uniform(image):
+    # blank slice for training filter, slices with NaN are dropped too
+    return bool(image.min() == image.max()) or not np.isfinite(image).all()
+
+
+def shard_folder(cfg, dataset_name):
+    return os.path.join(getattr(cfg, 'shard_folder', None) or os.path.join(cfg.data_folder, 'shards'), dataset_name)
+
+
+class ShardWriter:
+    # slices are appended patient by patient, index is written last on close,
+    # so shard without index is unfinished
+    def __init__(self, folder):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.names, self.shapes, self.patient_starts, self.uniform = [], [], [], []
+        self.image_dtype, self.mask_dtype = None, None
+        self._images = open(os.path.join(folder, IMAGES + '.tmp'), 'wb')
+        self._masks = open(os.path.join(folder, MASKS + '.tmp'), 'wb')
+
+    def new_patient(self):
+        self.patient_starts.append(len(self.names))
+
+    def add(self, name, image, mask, uniform=None):
+        # uniform flag can be computed on raw slice by caller
+        # one shape per slice in index, so mask offsets are the same as image ones
+        if mask.shape != image.shape:
+            raise ValueError(f'Image shape {image.shape} and mask shape {mask.shape} of \"{name}\" differ')
+
+        # every slice of shard is cast to dtypes of first one, offsets of index count elements of them
+        if self.image_dtype is None:
+            self.image_dtype, self.mask_dtype = image.dtype, mask.dtype
+        self._images.write(np.ascontiguousarray(image.astype(self.image_dtype, copy=False)).tobytes())
+        self._masks.write(np.ascontiguousarray(mask.astype(self.mask_dtype, copy=False)).tobytes())
+        self.names.append(name)
+        self.shapes.append(image.shape)
+        self.uniform.append(is_uniform(image) if uniform is None else bool(uniform))
+
+    def close(self):
+        self._images.close()
+        self._masks.close()
+        if not self.names:
+            raise ValueError(f'No slices for shard \"{self.folder}\"')
+        # patients without slices are dropped
+        starts = sorted(set(start for start in self.patient_starts if start < len(self.names)) | {0})
+        shapes = np.array(self.shapes, dtype=np.int64).reshape(len(self.names), -1)
+        offsets = np.concatenate([[0], np.cumsum(shapes.prod(1))[:-1]]).astype(np.int64)
+        np.savez(os.path.join(self.folder, INDEX + '.tmp.npz'), offsets=offsets, shapes=shapes,
+                 patient_starts=np.array(starts + [len(self.names)], dtype=np.int64), names=np.array(self.names),
+                 uniform=np.array(self.uniform, dtype=bool),
+                 image_dtype=np.dtype(self.image_dtype).str, mask_dtype=np.dtype(self.mask_dtype).str)
+
+        os.replace(os.path.join(self.folder, IMAGES + '.tmp'), os.path.join(self.folder, IMAGES))
+        os.replace(os.path.join(self.folder, MASKS + '.tmp'), os.path.join(self.folder, MASKS))
+        os.replace(os.path.join(self.folder, INDEX + '.tmp.npz'), os.path.join(self.folder, INDEX))
+        return len(self.names)
+
+
+def pack_dataset(paths, folder):
+    # paths are slice paths by patients like from get_paths_1_dataset
+    writer = ShardWriter(folder)
+    for patient in paths:
+        writer.new_patient()
+        for path in patient:
+            loaded = np.load(path)
+            writer.add(os.path.basename(path), loaded['image'], loaded['mask'])
+    return writer.close()
+
+
+def merge_shards(folders, folder):
+    # shards are joined in given order, every patient of them stays a patient
+    writer = ShardWriter(folder)
+    for part in folders:
+        shard = Shard(part)
+        starts = set(shard.patient_starts[:-1].tolist())
+        for i in range(len(shard)):
+            if i in starts:
+                writer.new_patient()
+            image, mask = shard.get(i)
+            writer.add(str(shard.names[i]), image, mask, shard.uniform[i])
+    return writer.close()
+
+
+class Shard:
+    # memory-mapped images and masks of packed dataset, files are mapped on first access,
+    # so shard is cheap to send to DataLoader workers
+    def __init__(self, folder):
+        self.folder = folder
+        with np.load(os.path.join(folder, INDEX)) as index:
+            self.offsets = index['offsets']
+            self.shapes = index['shapes']
+            self.patient_starts = index['patient_starts']
+            self.names = index['names']
+            self.uniform = index['uniform']
+            self.image_dtype = np.dtype(str(index['image_dtype']))
+            self.mask_dtype = np.dtype(str(index['mask_dtype']))
+        self._images = None
+        self._masks = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        state['_masks'] = None
+        return state
+
+    def patients(self):
+        # slice indices of every patient
+        return [list(range(start, stop)) for start, stop in zip(self.patient_starts[:-1], self.patient_starts[1:])]
+
+    def get(self, index):
+        # views of memory maps, nothing is copied or decoded
+        if self._images is None:
+            self._images = np.memmap(os.path.join(self.folder, IMAGES), dtype=self.image_dtype, mode='r')
+            self._masks = np.memmap(os.path.join(self.folder, MASKS), dtype=self.mask_dtype, mode='r')
+        shape = tuple(self.shapes[index])
+        start = self.offsets[index]
+        stop = start + int(np.prod(shape))
+        return self._images[start:stop].reshape(shape), self._masks[start:stop].reshape(shape)
+
+
+def load_shards(cfg):
+    names = cfg.dataset_name if isinstance(cfg.dataset_name, list) else [cfg.dataset_name]
+    return [Shard(shard_folder(cfg, name)) for name in names]
+
+
+def get_shard_paths(cfg, shards=None):
+    # global slice indices by patients, same structure as get_paths
+    shards = shards or load_shards(cfg)
+    paths, start = [], 0
+    for shard in shards:
+        paths.extend([[start + i for i in patient] for patient in shard.patients()])
+        start += len(shard)
+    return paths
+
+
+class ShardDataset(Dataset):
+    # Covid19Dataset on packed shards, paths are global slice indices from get_shard_paths
+    def __init__(self, shards, paths, transform=None):
+        self.shards = shards
+        self.paths = paths
+        self.transform = transform
+        self._starts = np.cumsum([0] + [len(shard) for shard in shards])
+        self._len = len(self.paths)
+
+    def __len__(self):
+        return self._len
+
+    def _locate(self, index):
+        # shard number and index of slice in it
+        path = int(self.paths[index])
+        number = int(np.searchsorted(self._starts, path, side='right')) - 1
+        return number, path - self._starts[number]
+
+    def uniform(self, index):
+        number, shard_index = self._locate(index)
+        return bool(self.shards[number].uniform[shard_index])
+
+    def patients(self):
+        # indices of dataset grouped by patient
+        groups = {}
+        for i in range(self._len):
+            number, shard_index = self._locate(i)
+            patient = np.searchsorted(self.shards[number].patient_starts, shard_index, side='right')
+            groups.setdefault((number, int(patient)), []).append(i)
+        return list(groups.values())
+
+    def __getitem__(self, index):
+        number, shard_index = self._locate(index)
+        image, mask = self.shards[number].get(shard_index)
+        if self.transform:
+            transformed = self.transform(image=np.asarray(image), mask=np.asarray(mask))
+            image = transformed['image']
+            mask = transformed['mask']
+        image = torch.from_numpy(np.array([image], dtype=np.float32))
+        mask = torch.from_numpy(np.array([mask], dtype=np.uint8))
+        return image, mask
+
+
+def pack(args):
+    names = args.dataset_name
+    for name in names:
+        paths = get_paths_1_dataset(args.data_folder, name)
+        folder = shard_folder(args, name)
+        start = time.perf_counter()
+        slices = pack_dataset(paths, folder)
+        print(f'{name}: {slices} slices of {len([p for p in paths if p])} patients to {folder} '
+              f'in {time.perf_counter() - start:.1f}s')
+
+
+def benchmark(args):
+    from data_functions import Covid19Dataset
+
+    for name in args.dataset_name:
+        paths = [path for patient in get_paths_1_dataset(args.data_folder, name) for path in patient]
+        shard = Shard(shard_folder(args, name))
+        datasets = dict(npz=Covid19Dataset(paths), shards=ShardDataset([shard], list(range(len(shard)))))
+        print(f'{name}: {len(paths)} slices')
+        for dataset_name, dataset in datasets.items():
+            loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+            start = time.perf_counter()
+            samples = 0
+            for X, _ in loader:
+                samples += len(X)
+                if args.samples and samples >= args.samples:
+                    break
+            print(f'{dataset_name:>7}: {samples / (time.perf_counter() - start):.1f} samples/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='packed memory-mapped training shards')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, help_text in [('pack', 'pack npz slices of datasets into shards'),
+                               ('benchmark', 'samples/s of npz slices and shards')]:
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument('--data_folder', required=True)
+        subparser.add_argument('--dataset_name', nargs='+', required=True)
+        subparser.add_argument('--shard_folder', default=None, help='default is <data_folder>/shards')
+        if command == 'benchmark':
+            subparser.add_argument('--batch_size', type=int, default=8)
+            subparser.add_argument('--num_workers', type=int, default=0)
+            subparser.add_argument('--samples', type=int, default=2000, help='max samples of every format')
+    args = parser.parse_args()
+    if args.command == 'pack':
+        pack(args)
+    else:
+        benchmark(args)
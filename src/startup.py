@@ -0,0 +1,63 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# every stage runs in fresh interpreter, so imports and models are really cold
+STAGES = {
+    'import': '''
+import production
+''',
+    'setup': '''
+from production import get_setup
+models, transforms = get_setup(lazy={lazy}, backend='{backend}')
+''',
+    'first binary slice': '''
+import torch
+from production import get_setup, get_predictions
+models, transforms = get_setup(lazy={lazy}, backend='{backend}')
+image = torch.rand(1, 512, 512).numpy()
+next(get_predictions(None, models, transforms, multi_class=False, volume=image))
+''',
+    'first multi slice': '''
+import torch
+from production import get_setup, get_predictions
+models, transforms = get_setup(lazy={lazy}, backend='{backend}')
+image = torch.rand(1, 512, 512).numpy()
+next(get_predictions(None, models, transforms, multi_class=True, volume=image))
+''',
+}
+
+TIMER = '''
+import time
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start)
+'''
+
+
+def measure(code, repeats):
+    # checkpoints paths are relative to repository root
+    folder = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=folder)
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', TIMER.format(code=code)], cwd=os.path.dirname(folder),
+                                env=env, capture_output=True, text=True)
+        if output.returncode != 0:
+            raise RuntimeError(output.stderr.strip().split('\n')[-1])
+        times.append(float(output.stdout.strip().split('\n')[-1]))
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='cold start time of production setup')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--backend', default='eager')
+    args = parser.parse_args()
+
+    print('stage              |   lazy  |  eager')
+    for name, code in STAGES.items():
+        lazy = measure(code.format(lazy=True, backend=args.backend), args.repeats)
+        eager = measure(code.format(lazy=False, backend=args.backend), args.repeats)
+        print(f'{name:<18} | {lazy:6.2f}s | {eager:6.2f}s')
@@ -13,20 +13,33 @@ def foo_():
     time.sleep(0.3)
 
 
-def train_epoch(model, train_dl, encoder, criterion, metric, optimizer, scheduler, device):
+def synchronize(device):
+    # queued GPU steps are finished before time is taken
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def train_epoch(model, train_dl, encoder, criterion, metric, optimizer, scheduler, device, log_interval=1,
+                check_blank=True, max_steps=None):
+    # loss and score are summed on device and read every log_interval steps,
+    # blank batches are checked here only if data pipeline doesn't remove blank slices,
+    # mean loss and score over read batches (all of loader unless max_steps stops earlier) and steps/s are returned
     model.train()
-    loss_sum = 0
-    score_sum = 0
+    loss_sum = torch.zeros((), device=device)
+    score_sum = torch.zeros((), device=device)
+    steps, batches = 0, 0
+    synchronize(device)
+    start = time.perf_counter()
     with tqdm(total=len(train_dl), position=0, leave=True) as pbar:
-        for X, y in tqdm(train_dl, position=0, leave=True):
-            pbar.update()
-            X = X.to(device)
-            if len(torch.unique(X)) == 1:
+        for i, (X, y) in enumerate(train_dl, 1):
+            batches = i
+            X = X.to(device, non_blocking=True)
+            if check_blank and len(torch.unique(X)) == 1:
                 continue
+            y = y.to(device, non_blocking=True)
             if encoder is not None:
                 y = encoder(y)
             y = y.squeeze(4)
-            y = y.to(device)
 
             optimizer.zero_grad()
             output = model(X)
@@ -35,39 +48,94 @@ def train_epoch(model, train_dl, encoder, criterion, metric, optimizer, schedule
             optimizer.step()
             scheduler.step()
 
-            loss = loss.item()
-            score = metric(output, y).mean().item()
-            loss_sum += loss
-            score_sum += score
-    return loss_sum / len(train_dl), score_sum / len(train_dl)
-
-
-def eval_epoch(model, val_dl, encoder, criterion, metric, device):
+            with torch.no_grad():
+                loss_sum += loss.detach()
+                score_sum += metric(output, y).mean()
+            steps += 1
+            if i % log_interval == 0 or i == len(train_dl):
+                pbar.update(i - pbar.n)
+                pbar.set_postfix(loss=f'{loss_sum.item() / steps:.6f}')
+            if max_steps and steps == max_steps:
+                break
+    synchronize(device)
+    seconds = time.perf_counter() - start
+    batches = max(batches, 1)
+    return loss_sum.item() / batches, score_sum.item() / batches, steps / max(seconds, 1e-9)
+
+
+def eval_epoch(model, val_dl, encoder, criterion, metric, device, log_interval=1, check_blank=True):
     model.eval()
-    loss_sum = 0
-    score_sum = 0
+    loss_sum = torch.zeros((), device=device)
+    score_sum = torch.zeros((), device=device)
+    steps = 0
+    synchronize(device)
+    start = time.perf_counter()
     with tqdm(total=len(val_dl), position=0, leave=True) as pbar:
-        for X, y in tqdm(val_dl, position=0, leave=True):
-            pbar.update()
-            X = X.to(device)
-            if len(torch.unique(X)) == 1:
+        for i, (X, y) in enumerate(val_dl, 1):
+            X = X.to(device, non_blocking=True)
+            if check_blank and len(torch.unique(X)) == 1:
                 continue
+            y = y.to(device, non_blocking=True)
             if encoder is not None:
                 y = encoder(y)
             y = y.squeeze()
-            y = y.to(device)
 
             with torch.no_grad():
                 output = model(X)
-                loss = criterion(output, y).item()
-                score = metric(output, y).mean().item()
-                loss_sum += loss
-                score_sum += score
-    return loss_sum / len(val_dl), score_sum / len(val_dl)
+                loss_sum += criterion(output, y)
+                score_sum += metric(output, y).mean()
+            steps += 1
+            if i % log_interval == 0 or i == len(val_dl):
+                pbar.update(i - pbar.n)
+    synchronize(device)
+    seconds = time.perf_counter() - start
+    return loss_sum.item() / len(val_dl), score_sum.item() / len(val_dl), steps / max(seconds, 1e-9)
+
+
+def loop_params(cfg):
+    # blank slices are removed by data pipeline with skip_uniform_slices
+    return dict(log_interval=getattr(cfg, 'log_interval', 1),
+                check_blank=not getattr(cfg, 'skip_uniform_slices', False))
 
 
-def run(cfg, model_name, use_wandb=True, max_early_stopping=2):
+class LoaderOverride:
+    # model config with some loading parameters replaced
+    def __init__(self, cfg, **params):
+        self._cfg = cfg
+        self.__dict__.update(params)
+
+    def __getattr__(self, name):
+        return getattr(self._cfg, name)
+
+
+# previous plain DataLoader: no workers, pinning, patient order or blank slice filter
+PLAIN_LOADING = dict(num_workers=0, pin_memory=False, persistent_workers=False, patient_sampler=False,
+                     skip_uniform_slices=False)
+
+
+def compare_loops(cfg, steps=100):
+    # steps/s of previous loop (plain loader, sync every step) and of loop and loader from config,
+    # fresh model for each
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    for name, loop_cfg, params in [('previous', LoaderOverride(cfg, **PLAIN_LOADING),
+                                    dict(log_interval=1, check_blank=True)),
+                                   ('config', cfg, loop_params(cfg))]:
+        train_loader, _ = get_loaders(loop_cfg)
+        model = get_model(cfg)(cfg=cfg).to(device)
+        optimizer = get_optimizer(cfg)(model.parameters(), **cfg.optimizer_params)
+        scheduler = get_scheduler(cfg)(optimizer, **cfg.scheduler_params)
+        metric = get_metric(cfg)(**cfg.metric_params)
+        criterion = get_criterion(cfg)(**cfg.criterion_params)
+        *_, steps_per_second = train_epoch(model, train_loader, OneHotEncoder(cfg), criterion, metric, optimizer,
+                                           scheduler, device, max_steps=steps, **params)
+        print(f'{name}: {steps_per_second:.2f} steps/s')
+
+
+def run(cfg, model_name, use_wandb=True, max_early_stopping=2, compare_steps=None):
+    # with compare_steps steps/s of previous and configured loops are printed before training
     torch.cuda.empty_cache()
+    if compare_steps:
+        compare_loops(cfg, compare_steps)
 
     # <<<<< SETUP >>>>>
     train_loader, val_loader = get_loaders(cfg)
@@ -95,16 +163,16 @@ def run(cfg, model_name, use_wandb=True, max_early_stopping=2):
         print(f'Epoch #{epoch}')
 
         # <<<<< TRAIN >>>>>
-        train_loss, train_score = train_epoch(model, train_loader, encoder,
-                                              criterion, metric,
-                                              optimizer, scheduler, device)
-        print('      Score    |    Loss')
-        print(f'Train: {train_score:.6f} | {train_loss:.6f}')
+        train_loss, train_score, train_speed = train_epoch(model, train_loader, encoder,
+                                                           criterion, metric,
+                                                           optimizer, scheduler, device, **loop_params(cfg))
+        print('      Score    |    Loss    | steps/s')
+        print(f'Train: {train_score:.6f} | {train_loss:.6f} | {train_speed:.2f}')
 
         # <<<<< EVAL >>>>>
-        val_loss, val_score = eval_epoch(model, val_loader, encoder,
-                                         criterion, metric, device)
-        print(f'Val: {val_score:.6f} | {val_loss:.6f}', end='\n\n')
+        val_loss, val_score, val_speed = eval_epoch(model, val_loader, encoder,
+                                                    criterion, metric, device, **loop_params(cfg))
+        print(f'Val: {val_score:.6f} | {val_loss:.6f} | {val_speed:.2f}', end='\n\n')
         metrics = {'train_score': train_score,
                    'train_loss': train_loss,
                    'val_score': val_score,
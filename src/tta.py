@@ -0,0 +1,175 @@
+import argparse
+import os
+import time
+import numpy as np
+import torch
+from config import ProductionConfig
+
+# invertible flips and rotations of (..., height, width) tensors
+VIEWS = ('identity', 'hflip', 'vflip', 'rot90', 'rot180', 'rot270', 'transpose', 'antitranspose')
+
+
+def augment(X, view):
+    if view == 'identity':
+        return X
+    if view == 'hflip':
+        return X.flip(-1)
+    if view == 'vflip':
+        return X.flip(-2)
+    if view == 'rot90':
+        return torch.rot90(X, 1, (-2, -1))
+    if view == 'rot180':
+        return X.flip(-2, -1)
+    if view == 'rot270':
+        return torch.rot90(X, -1, (-2, -1))
+    if view == 'transpose':
+        return X.transpose(-2, -1)
+    if view == 'antitranspose':
+        return X.flip(-2, -1).transpose(-2, -1)
+    raise ValueError(f'View \"{view}\" is not in {VIEWS}')
+
+
+def deaugment(Y, view):
+    # rotations are inverted by opposite ones, other views are their own inverses
+    if view == 'rot90':
+        return augment(Y, 'rot270')
+    if view == 'rot270':
+        return augment(Y, 'rot90')
+    return augment(Y, view)
+
+
+class TTAPredict:
+    # ModelRunner predict function: views of batch are stacked into one forward pass
+    # (two for rotations of not square inputs), outputs are turned back and merged on device,
+    # softmax is averaged for models returning logits, argmax maps of exported models are voted
+    def __init__(self, views):
+        self.views = ('identity',) + tuple(view for view in views if view != 'identity')
+        for view in self.views:
+            if view not in VIEWS:
+                raise ValueError(f'View \"{view}\" is not in {VIEWS}')
+
+    def __call__(self, model, X):
+        groups = {}
+        for view in self.views:
+            augmented = augment(X, view)
+            groups.setdefault(tuple(augmented.shape), []).append((view, augmented))
+
+        probs, votes = None, []
+        with torch.no_grad():
+            for group in groups.values():
+                outputs = model(torch.cat([augmented for _, augmented in group]))
+                for (view, _), output in zip(group, outputs.to(X.device).chunk(len(group))):
+                    output = deaugment(output, view)
+                    if output.dim() == 3:  # argmax maps of exported models
+                        votes.append(output)
+                    elif probs is None:
+                        probs = torch.softmax(output.float(), 1)
+                    else:
+                        probs += torch.softmax(output.float(), 1)
+        if votes:
+            return torch.mode(torch.stack(votes).long(), 0).values.to(torch.uint8)
+        return torch.argmax(probs, 1).to(torch.uint8)
+
+
+def tta_views(policy=None):
+    policy = policy or ProductionConfig.tta
+    if policy not in ProductionConfig.tta_policies:
+        raise ValueError(f'TTA policy \"{policy}\" is not in {tuple(ProductionConfig.tta_policies)}')
+    return ProductionConfig.tta_policies[policy]
+
+
+def load_labeled(folder, slices=None):
+    # training slices "<patient>_<slice>.npz" with image and mask
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith('.npz'))
+    if slices:
+        paths = paths[::max(1, len(paths) // slices)][:slices]
+    images, masks = [], []
+    for path in paths:
+        loaded = np.load(path)
+        images.append(loaded['image'].astype(np.float32))
+        masks.append(loaded['mask'].astype(np.int64))
+    return images, masks
+
+
+def labeled_dice(model, predict, images, masks, transform, batch_size, device):
+    # mean dice of every class except background and seconds of prediction
+    import cv2
+    from engine import ModelRunner
+    from evaluation import dice
+
+    runner = ModelRunner([model], device, concurrent=False, predict=predict)
+    seconds = 0
+    scores = {}
+    for start in range(0, len(images), batch_size):
+        batch = [transform(image=image)['image'] for image in images[start:start + batch_size]]
+        X = torch.from_numpy(np.stack(batch)[:, None]).to(device)
+        X = X / torch.amax(X, dim=(1, 2, 3), keepdim=True).clamp(min=1e-9)
+        begin = time.perf_counter()
+        pred, = runner.run([(0, X)])
+        pred = pred.cpu().numpy()
+        seconds += time.perf_counter() - begin
+        for p, mask in zip(pred, masks[start:start + batch_size]):
+            mask = cv2.resize(mask.astype(np.uint8), p.shape[::-1], interpolation=cv2.INTER_NEAREST)
+            for label in np.unique(mask[mask > 0]):
+                scores.setdefault(int(label), []).append(dice(p == label, mask == label))
+    runner.close()
+    return float(np.mean([np.mean(values) for values in scores.values()])) if scores else float('nan'), seconds
+
+
+def report(args):
+    from production import get_setup, data_to_studies, MODEL_OUTPUTS
+    from evaluation import run_pipeline, compare_predictions
+
+    policies = list(ProductionConfig.tta_policies)
+    if args.policy != 'all':
+        policies = list(dict.fromkeys(['none', args.policy]))
+    models, transforms = get_setup(fused=False, lazy=False)  # fused model has no TTA
+
+    if args.data:
+        # agreement with predictions without TTA and throughput of whole pipeline
+        studies = data_to_studies(args.data, args.save_folder)
+        reference, reference_time, _ = run_pipeline(studies, models, transforms, tta='none')
+        slices = len(reference)
+        print(f'Slices: {slices}')
+        print('policy    | views | ground-glass | consolidation |  lungs  | percent error | slices/s')
+        for policy in policies:
+            if policy == 'none':
+                predictions, seconds = reference, reference_time
+            else:
+                predictions, seconds, _ = run_pipeline(studies, models, transforms, tta=policy)
+            scores = compare_predictions(reference, predictions)
+            print(f'{policy:<9} | {len(tta_views(policy)) + 1:5d} | {scores["ground-glass"]:12.4f} | '
+                  f'{scores["consolidation"]:13.4f} | {scores["lungs"]:7.4f} | '
+                  f'{scores["percent_error"]:6.3f} ({scores["max_percent_error"]:.3f}) | {slices / seconds:8.2f}')
+
+    if args.labels:
+        # accuracy against ground truth masks of one model
+        from engine import predict_argmax
+
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        index = MODEL_OUTPUTS.index(args.model)
+        images, masks = load_labeled(args.labels, args.slices)
+        print(f'Labeled slices of {args.model} model: {len(images)}')
+        print('policy    | views |  dice  | slices/s')
+        for policy in policies:
+            views = tta_views(policy)
+            predict = TTAPredict(views) if views else predict_argmax
+            score, seconds = labeled_dice(models[index], predict, images, masks, transforms[index],
+                                          args.batch_size or ProductionConfig.batch_size, device)
+            print(f'{policy:<9} | {len(views) + 1:5d} | {score:.4f} | {len(images) / max(seconds, 1e-9):8.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='throughput and accuracy of test-time augmentation policies')
+    parser.add_argument('--data', default=None, help='images or NIfTI, policies are compared with no TTA')
+    parser.add_argument('--save_folder', default='tta')
+    parser.add_argument('--labels', default=None, help='folder of labeled npz slices for dice with ground truth')
+    parser.add_argument('--model', default='binary', choices=['binary', 'multi', 'lung'],
+                        help='model whose masks are in --labels')
+    parser.add_argument('--slices', type=int, default=None, help='max labeled slices')
+    parser.add_argument('--batch_size', type=int, default=None)
+    parser.add_argument('--policy', default='all', help='policy from ProductionConfig.tta_policies or \"all\"')
+    args = parser.parse_args()
+    if not args.data and not args.labels:
+        parser.error('--data or --labels is required')
+    report(args)
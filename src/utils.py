@@ -76,21 +76,15 @@ def get_paths(cfg):
 
 
 class OneHotEncoder:
+    # masks are encoded on their own device, so encoder is called after transfer,
+    # (batch, 1, height, width) masks become (batch, classes, height, width, 1) float tensors
     def __init__(self, cfg):
-        self.zeros = [0] * cfg.num_classes
-
-    def encode_num(self, x):
-        zeros = self.zeros.copy()
-        zeros[int(x)] = 1
-        return zeros
+        self.num_classes = cfg.num_classes
 
     def __call__(self, y):
-        y = np.array(y)
-        y = np.expand_dims(y, -1)
-        y = np.apply_along_axis(self.encode_num, -1, y)
-        y = np.swapaxes(y, -1, 1)
-        y = np.ascontiguousarray(y)
-        return torch.Tensor(y)
+        y = torch.as_tensor(y)
+        y = torch.nn.functional.one_hot(y.long(), self.num_classes)
+        return y.transpose(-1, 1).float().contiguous()
 
 
 class FakeScheduler:
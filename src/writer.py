@@ -0,0 +1,62 @@
+import queue
+import threading
+from production import save_mask
+
+
+class OutputError(Exception):
+    pass
+
+
+class OutputWriter:
+    # masks, annotations and archive entries are written by background thread,
+    # queue is bounded, so predictions wait when writing is slower than models
+    def __init__(self, save_folder, show_legend=False, zip_file=None, max_queue=32):
+        self.save_folder = save_folder
+        self.show_legend = show_legend
+        self.zip_file = zip_file
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.errors = []
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, img, annotation, path):
+        self.queue.put((img, annotation, path))
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                img, annotation, path = item
+                mask_path, annotation_path = save_mask(img, annotation, path, self.save_folder, self.show_legend)
+                if self.zip_file is not None:
+                    self.zip_file.write(mask_path)
+                    self.zip_file.write(annotation_path)
+            except Exception as e:
+                self.errors.append(f'{path}: {type(e).__name__}: {e}')
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        # waits for everything submitted, errors are raised in submission order
+        self.queue.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise OutputError(f'{len(errors)} outputs were not written:\n' + '\n'.join(errors))
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._thread.is_alive():  # error is already raised, outputs are finished silently
+            self.queue.put(None)
+            self._thread.join()
@@ -4,16 +4,32 @@ import numpy as np
 from zipfile import ZipFile
 import os
 import cv2
-from src.production import read_files, get_setup, make_masks, create_folder, make_legend
+from src.production import read_files, get_setup, make_masks, get_predictions, create_folder, make_legend, get_cache
+from src.client import InferenceClient
+from src.writer import OutputWriter, OutputError
+from src.config import ProductionConfig
 
 
-@st.cache
+@st.cache(allow_output_mutation=True)  # models are loaded lazily, so setup changes after caching
 def cached_get_setup():
     return get_setup()
 
 
+def keep_image(predictions, image):
+    # normalized slice of current prediction is kept for display, so volume isn't read again
+    for prediction in predictions:
+        image[:] = [prediction[0]]
+        yield prediction
+
+
 def main():
-    models, transforms = cached_get_setup()
+    # running inference server (src/server.py) is shared by every user, otherwise models are loaded here
+    client = InferenceClient()
+    if client.available():
+        models, transforms = None, None
+    else:
+        client = None
+        models, transforms = cached_get_setup()
     st.markdown(
         f"""
     <style>
@@ -51,8 +67,8 @@ def main():
     show_legend = st.checkbox(label='Легенда на картинке', value=False)
 
     if st.button('Загрузить') and filenames:
-        paths, folder_name = read_files(filenames)
-        if not paths:
+        studies, folder_name = read_files(filenames)
+        if not studies:
             st.error('Неправильный формат или название файла')
         else:
             user_dir = "segmentations/" + folder_name
@@ -65,16 +81,22 @@ def main():
             zip_obj = ZipFile(user_dir + 'segmentations.zip', 'w')
             with st.expander("Информация о каждом фото"):
                 info = st.info('Делаем предсказания, пожалуйста, подождите')
-                for _paths in paths:
-                    for img, annotation, original_path in make_masks(_paths, models, transforms, multi_class):
+
+                # masks, annotations and archive are written in background
+                writer = OutputWriter(user_dir, zip_file=zip_obj, max_queue=ProductionConfig.writer_queue)
+                for _paths, volume in studies:
+                    if client is not None:
+                        predictions = client.get_predictions(_paths, multi_class, volume)
+                    else:
+                        predictions = get_predictions(_paths, models, transforms, multi_class, volume=volume,
+                                                      cache=get_cache())
+                    slice_image = []
+                    predictions = keep_image(predictions, slice_image)
+                    masks = make_masks(_paths, None, None, multi_class, predictions=predictions)
+                    for img, annotation, original_path, _ in masks:
                         name = original_path.split('/')[-1].split('.')[0]
                         name = name.replace('\\', '/')
 
-                        # saving annotation
-                        annotation_path = os.path.join(user_dir, 'annotations', name + '_annotation.txt')
-                        with open(annotation_path, mode='w') as f:
-                            f.write(annotation)
-
                         info.empty()
 
                         # name and annotation
@@ -91,7 +113,10 @@ def main():
                         col1, col2 = st.columns(2)
 
                         # original image
-                        original = np.array(Image.open(original_path))
+                        if volume is not None:  # NIfTI slice from prediction
+                            original = slice_image[0]
+                        else:
+                            original = np.array(Image.open(original_path))
                         col1.header("Оригинал")
                         col1.image(original, width=350)
 
@@ -99,13 +124,8 @@ def main():
                         if show_legend:
                             img = make_legend(img, annotation)
 
-                        # saving image
-                        path = os.path.join(user_dir, 'segmentations', name + '_mask.png')
-                        cv2.imwrite(path, img)
-
-                        # adding in zip
-                        zip_obj.write(path)
-                        zip_obj.write(annotation_path)
+                        # saving image, annotation and adding in zip
+                        writer.submit(img, annotation, original_path)
 
                         # show segmentation
                         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -116,6 +136,17 @@ def main():
 
                         st.markdown('<br />', unsafe_allow_html=True)
 
+                    if volume is not None:  # clearing uploaded NIfTI
+                        volume.close()
+                        os.remove(volume.path)
+
+                    # every study is written before the next one
+                    try:
+                        writer.flush()
+                    except OutputError as e:
+                        st.error(str(e))
+
+                writer.close()
                 zip_obj.close()
 
             # download segmentation zip
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules of src import each other by plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
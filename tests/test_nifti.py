@@ -0,0 +1,25 @@
+import numpy as np
+from nifti import normalize_slice, window_volume
+
+
+def test_window_volume_matches_normalize_slice():
+    rng = np.random.default_rng(0)
+    images = rng.integers(-2000, 1500, size=(6, 32, 24)).astype(np.int16)
+    expected = np.stack([normalize_slice(image.astype(np.float32)) for image in images])
+    np.testing.assert_allclose(window_volume(images), expected, rtol=1e-6)
+
+
+def test_window_volume_float64_matches_normalize_slice():
+    rng = np.random.default_rng(1)
+    images = rng.uniform(-2000, 1500, size=(3, 16, 16))
+    expected = np.stack([normalize_slice(image) for image in images])
+    np.testing.assert_allclose(window_volume(images), expected, rtol=1e-6)
+
+
+def test_window_volume_uniform_slices_are_zero():
+    # slice of one value below window has zero range after shift
+    images = np.stack([np.full((8, 8), -3000, dtype=np.int16), np.arange(64, dtype=np.int16).reshape(8, 8) - 1000])
+    result = window_volume(images)
+    assert not np.isnan(result).any()
+    np.testing.assert_array_equal(result[0], 0)
+    np.testing.assert_allclose(result[1], normalize_slice(images[1].astype(np.float32)), rtol=1e-6)
@@ -0,0 +1,87 @@
+import pytest
+import torch
+from engine import ModelRunner
+from production import predict_maps, is_out_of_memory, MODEL_OUTPUTS
+
+SIZE = 128
+LUNG_SLICES = [0, 2, 3]
+
+
+class LungModel(torch.nn.Module):
+    # left lung where input is bright
+    def forward(self, X):
+        lung = (X > 0.5).float()
+        return torch.cat([1 - lung, lung, torch.zeros_like(lung)], 1)
+
+
+class DiseaseModel(torch.nn.Module):
+    # first lesion class everywhere, seen slices are counted
+    def __init__(self, classes):
+        super().__init__()
+        self.classes = classes
+        self.slices = 0
+
+    def forward(self, X):
+        self.slices += len(X)
+        logits = torch.zeros((len(X), self.classes) + tuple(X.shape[2:]))
+        logits[:, 1] = 1
+        return logits
+
+
+class LimitedModel(DiseaseModel):
+    # CPU allocator fails on batches over limit
+    def __init__(self, classes, limit):
+        super().__init__(classes)
+        self.limit = limit
+        self.batches = []
+
+    def forward(self, X):
+        if len(X) > self.limit:
+            raise RuntimeError("DefaultCPUAllocator: can't allocate memory: you tried to allocate 1 bytes")
+        self.batches.append(len(X))
+        return super().forward(X)
+
+
+def make_batch(slices=5):
+    X = torch.zeros(slices, 1, SIZE, SIZE)
+    for i in LUNG_SLICES:
+        X[i, 0, 40:60, 30:70] = 1
+    return X
+
+
+@pytest.mark.parametrize('lungs_first', ['skip', 'crop'])
+def test_disease_models_skip_exactly_slices_without_lungs(lungs_first):
+    models = [DiseaseModel(2), DiseaseModel(4), LungModel()]
+    runner = ModelRunner(models, torch.device('cpu'), concurrent=False)
+    X = make_batch()
+    stats = {}
+    (_, maps, _), = predict_maps([(X, None)], runner, MODEL_OUTPUTS, len(X), torch.device('cpu'),
+                                 lungs_first=lungs_first, stats=stats)
+
+    empty = [i for i in range(len(X)) if not maps['lung'][i].bool().any()]
+    assert empty == [i for i in range(len(X)) if i not in LUNG_SLICES]
+    assert stats == dict(slices=len(X), skipped=len(empty))
+    for name, model in zip(MODEL_OUTPUTS[:2], models[:2]):
+        assert model.slices == len(LUNG_SLICES)
+        assert not maps[name][empty].any()
+        assert maps[name][LUNG_SLICES].flatten(1).bool().any(1).all()
+        if lungs_first == 'crop':  # only window around lungs is predicted
+            assert not maps[name][LUNG_SLICES].bool().all()
+
+
+def test_batch_is_halved_on_cpu_out_of_memory():
+    models = [LimitedModel(2, 2), DiseaseModel(4), LimitedModel(3, 2)]
+    runner = ModelRunner(models, torch.device('cpu'), concurrent=False)
+    X = make_batch(7)
+    chunks = list(predict_maps([(X, None)], runner, ('binary', 'lung'), 8, torch.device('cpu')))
+
+    assert sum(len(img) for img, _, _ in chunks) == len(X)
+    assert max(len(img) for img, _, _ in chunks) == 2
+    assert sum(models[0].batches) == len(X)
+
+
+def test_out_of_memory_errors():
+    assert is_out_of_memory(RuntimeError('CUDA out of memory. Tried to allocate 2.00 GiB'))
+    assert is_out_of_memory(RuntimeError("DefaultCPUAllocator: can't allocate memory: you tried to allocate 8 bytes"))
+    assert not is_out_of_memory(RuntimeError('size mismatch'))
+    assert not is_out_of_memory(ValueError('out of memory'))
@@ -0,0 +1,16 @@
+import torch
+from utils import OneHotEncoder
+from one_hot_benchmark import ReferenceOneHotEncoder, EncoderConfig
+
+
+def test_one_hot_encoder_matches_per_pixel_reference():
+    cfg = EncoderConfig(4)
+    torch.manual_seed(0)
+    y = torch.randint(0, cfg.num_classes, (2, 1, 16, 12), dtype=torch.uint8)
+    reference = ReferenceOneHotEncoder(cfg)(y)
+    encoded = OneHotEncoder(cfg)(y)
+
+    assert encoded.shape == reference.shape == (2, cfg.num_classes, 16, 12, 1)
+    assert encoded.dtype == reference.dtype == torch.float32
+    assert encoded.is_contiguous()
+    assert torch.equal(encoded, reference)